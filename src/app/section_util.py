@@ -6,10 +6,14 @@ This module contains utility functions related to ``nrn.Section`` objects.
 @author: Loïc Bertrand
 """
 
-from typing import List, Iterable, Optional
+import hashlib
+from typing import Dict, List, Iterable, Optional, Tuple
 
+import numpy as np
 from neuron import h, nrn
 
+from src.core.morphofiltd import Branch, resamplePath
+
 
 def clearNeuronSections():
     """
@@ -68,3 +72,100 @@ def avg(numbers: List[float]) -> Optional[float]:
     if not numbers:
         return None
     return sum(numbers) / len(numbers)
+
+
+def morphologyKey(sections: Iterable[nrn.Section]) -> str:
+    """
+    :param sections:    iterable of ``nrn.Section`` (List[Section] or SectionList)
+    :return:            identifier of the morphology (names, dimensions,
+        3D points and connections of the sections)
+    """
+    digest = hashlib.sha256()
+    for sec in sections:
+        parent = sec.parentseg()
+        digest.update(repr((sec.hname(), sec.L, sec.diam, sec.nseg,
+                            None if parent is None else (parent.sec.hname(), parent.x),
+                            sec.orientation())).encode())
+        digest.update(points3d(sec).tobytes())
+    return digest.hexdigest()
+
+
+def points3d(sec: nrn.Section) -> np.ndarray:
+    """
+    :param sec:     section with 3D points (see ``h.define_shape``)
+    :return:        3D points of the section (n3d x 3)
+    """
+    return np.array([[sec.x3d(i), sec.y3d(i), sec.z3d(i)] for i in range(int(sec.n3d()))])
+
+
+def axonPath(sections: Iterable[nrn.Section], dk: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Takes an iterable of ``nrn.Section`` objects and returns the geometry
+    of the soma and of the axon for ``morphofiltdPath``, from the 3D points
+    of the sections (sections are recognized by their name, like in
+    ``computeDimensions``).
+
+    :param sections:    iterable of ``nrn.Section`` (List[Section] or SectionList)
+    :param dk:          length of the axon compartments (μm)
+    :return:            soma center (1 x 3), beginning of each axon compartment (N x 3)
+    """
+    soma = axon = None
+    for sec in sections:
+        name: str = sec.hname()
+        if soma is None and name.find('soma') >= 0:
+            soma = points3d(sec)
+        elif axon is None and name.find('axon') >= 0:
+            axon = points3d(sec)
+    if soma is None or axon is None or len(soma) == 0 or len(axon) < 2:
+        raise ValueError('the cell needs a soma and an axon with 3D points')
+    r0 = (soma[0] + soma[-1]) / 2
+    # the axon starts at the end closest to the soma
+    if np.linalg.norm(axon[-1] - r0) < np.linalg.norm(axon[0] - r0):
+        axon = axon[::-1]
+    return r0, resamplePath(axon, dk)
+
+
+def cellBranches(sections: Iterable[nrn.Section]) -> Tuple[np.ndarray, List[Branch]]:
+    """
+    Takes an iterable of ``nrn.Section`` objects (e.g. ``LFPy.Cell.allseclist``
+    or ``CellModel.toSectionList()``) and returns the geometry of the cell
+    for ``morphofiltdTree``: every section but the soma becomes a branch,
+    oriented away from the soma, with its path distance from the soma.
+
+    :param sections:    iterable of ``nrn.Section`` (List[Section] or SectionList)
+    :return:            soma center (1 x 3), branches of the cell
+    """
+    sections = list(sections)
+    soma = next((sec for sec in sections if sec.hname().find('soma') >= 0), None)
+    if soma is None or soma.n3d() == 0:
+        raise ValueError('the cell needs a soma with 3D points')
+    somaPoints = points3d(soma)
+    offsets: Dict[str, float] = {soma.hname(): 0}
+
+    def offset(sec: nrn.Section) -> float:
+        # path distance from the soma to the proximal end of the section
+        name = sec.hname()
+        if name not in offsets:
+            ref = h.SectionRef(sec=sec)
+            if not ref.has_parent():
+                offsets[name] = 0
+            else:
+                parent = ref.parent
+                x = sec.parentseg().x
+                if parent.hname() != soma.hname():
+                    x = abs(x - parent.orientation())
+                    offsets[name] = offset(parent) + x * parent.L
+                else:
+                    offsets[name] = 0
+        return offsets[name]
+
+    branches = []
+    for sec in sections:
+        if sec.hname() == soma.hname() or sec.n3d() < 2:
+            continue
+        points = points3d(sec)
+        # the 3D points go from the 0 end to the 1 end of the section
+        if sec.orientation() == 1:
+            points = points[::-1]
+        branches.append(Branch(points, offset(sec)))
+    return (somaPoints[0] + somaPoints[-1]) / 2, branches
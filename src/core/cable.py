@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains a multi-compartment cable solver which does not depend
+on NEURON. It takes the topology of a ``CellModel`` (sections, nseg, L,
+diam, mechanism and connections), integrates the cable equation with
+Hodgkin–Huxley (``hh``) and passive (``pas``) compartments, and yields the
+membrane current of every segment, like ``LFPy.Cell.imem``.
+
+The voltage is integrated with a backward Euler step (membrane conductances
+taken at the updated gates, the tree matrix being solved with the Hines
+algorithm) and the HH gates with the exponential Euler scheme, which is
+stable with NEURON's default time step of 0.025 ms.
+
+Units follow NEURON: μm, ms, mV, μF/cm², Ω·cm, S/cm² for the mechanisms and
+nA for the currents.
+
+@author: Loïc Bertrand, Tony Zhou
+"""
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+import numpy as np
+from numpy import pi
+
+from src.core import hh_rates
+from src.core.hhrun import HHParams
+
+if TYPE_CHECKING:
+    from src.app.model import CellModel, SectionModel
+
+
+@dataclass
+class CableStimulus:
+    """
+    Current clamp (``IClamp``) on the segment of ``section`` containing ``x``
+    """
+    section: str
+    x: float = 0.5
+    amp: float = 0.2  # nA
+    dur: float = 10  # ms
+    delay: float = 1  # ms
+
+
+@dataclass
+class CableResult:
+    t: np.ndarray  # time vector (ms)
+    V: np.ndarray  # membrane voltage of each segment (segments x time), mV
+    imem: np.ndarray  # membrane current of each segment (segments x time), nA
+    segments: List[Tuple[str, float]]  # (section name, x) of each segment
+    area: np.ndarray  # membrane area of each segment, μm²
+
+
+def lambdaNseg(L: float, diam: float, Ra: float, cm: float, lambdaF: float = 100) -> int:
+    """
+    Number of segments given by the d_lambda rule (``nsegs_method='lambda_f'``
+    in LFPy).
+    """
+    lam = 1e5 * np.sqrt(diam / (4 * pi * lambdaF * Ra * cm))
+    return int((L / (0.1 * lam) + 0.9) / 2) * 2 + 1
+
+
+class _Compartments:
+    """
+    Compartments of a cell in Hines order (each parent before its children)
+    """
+
+    def __init__(self, sections: List['SectionModel'], Ra: float, cm: float,
+                 lambdaF: Optional[float]):
+        names = [sec.name for sec in sections]
+        children = {name: [] for name in names}
+        roots = []
+        for sec in sections:
+            if sec.parentSec is None:
+                roots.append(sec)
+            elif sec.parentSec.name not in children:
+                raise ValueError(f'parent of section {sec.name} is not part of the cell')
+            else:
+                children[sec.parentSec.name].append(sec)
+
+        self.segments: List[Tuple[str, float]] = []
+        self.parent: List[int] = []
+        self.length: List[float] = []
+        self.diam: List[float] = []
+        self.mechanism: List[Optional[str]] = []
+        # index of the compartments of each section, by increasing x
+        self.sectionIdx = {}
+
+        stack = [(sec, -1) for sec in reversed(roots)]
+        while stack:
+            sec, parentIdx = stack.pop()
+            if sec.name in self.sectionIdx:
+                raise ValueError(f'section {sec.name} is connected twice')
+            nseg = sec.nseg if lambdaF is None else lambdaNseg(sec.L, sec.diam, Ra, cm, lambdaF)
+            ks = range(nseg) if sec.parentSec is None or sec.childEnd == 0 else reversed(range(nseg))
+            idx = [0] * nseg
+            for k in ks:
+                idx[k] = len(self.parent)
+                self.parent.append(parentIdx)
+                parentIdx = idx[k]
+                self.segments.append((sec.name, (k + 0.5) / nseg))
+                self.length.append(sec.L / nseg)
+                self.diam.append(sec.diam)
+                self.mechanism.append(sec.mechanism)
+            self.sectionIdx[sec.name] = idx
+            for child in reversed(children[sec.name]):
+                stack.append((child, idx[0] if child.parentEnd == 0 else idx[-1]))
+        if len(self.sectionIdx) != len(sections):
+            raise ValueError('the cell topology contains a loop')
+
+        self.parent = np.array(self.parent)
+        self.length = np.array(self.length, dtype=float)
+        self.diam = np.array(self.diam, dtype=float)
+        self.area = pi * self.diam * self.length  # μm²
+        # axial conductance (μS) between each compartment and its parent,
+        # through half of each compartment
+        halfR = Ra * (self.length / 2) / (pi * (self.diam / 2) ** 2) * 1e4  # Ω
+        child = np.flatnonzero(self.parent >= 0)
+        self.edgeChild = child
+        self.edgeParent = self.parent[child]
+        self.edgeG = 1e6 / (halfR[child] + halfR[self.edgeParent])
+
+    def __len__(self):
+        return len(self.parent)
+
+    def index(self, section: str, x: float) -> int:
+        idx = self.sectionIdx[section]
+        return idx[min(int(x * len(idx)), len(idx) - 1)]
+
+
+def _hinesSolve(d: list, b: list, rhs: list, parent: list) -> list:
+    """
+    Solves the tree system (compartments in Hines order) of diagonal ``d``,
+    symmetric coupling ``b`` between each compartment and its parent, and
+    right-hand side ``rhs``. ``d`` and ``rhs`` are modified in place.
+    """
+    n = len(d)
+    for i in range(n - 1, 0, -1):
+        p = parent[i]
+        if p >= 0:
+            f = b[i] / d[i]
+            d[p] -= f * b[i]
+            rhs[p] -= f * rhs[i]
+    V = [0.0] * n
+    for i in range(n):
+        p = parent[i]
+        V[i] = (rhs[i] - b[i] * V[p]) / d[i] if p >= 0 else rhs[i] / d[i]
+    return V
+
+
+def simulateCable(cell: 'CellModel',
+                  stimulus: CableStimulus,
+                  tstop: float = 20,
+                  dt: float = 0.025,
+                  Ra: float = 150,
+                  cm: float = 1,
+                  vInit: float = -65,
+                  passive: Optional[Tuple[float, float]] = (1 / 30000, -65),
+                  lambdaF: Optional[float] = 100,
+                  params: Optional[HHParams] = None) -> CableResult:
+    """
+    Simulates a cell with the native cable solver. The default arguments
+    match the ``LFPy.Cell`` parameters used by the application.
+
+    :param cell:        cell model (any object with a ``sections`` list of
+        ``SectionModel``-like objects)
+    :param stimulus:    current clamp
+    :param tstop:       duration of the simulation (ms)
+    :param dt:          time step (ms)
+    :param Ra:          axial resistance (Ω·cm)
+    :param cm:          membrane capacitance (μF/cm²)
+    :param vInit:       initial membrane voltage (mV)
+    :param passive:     ``(g_pas, e_pas)`` of a passive mechanism inserted in
+        every section (S/cm², mV), or ``None``
+    :param lambdaF:     frequency of the d_lambda rule for the number of
+        segments, or ``None`` to use the ``nseg`` of each section
+    :param params:      HH constants of the ``hh`` compartments (mS/cm²,
+        default: ``HHParams()``), ``params.Cm`` is ignored in favour of ``cm``
+    :return:            a ``CableResult``
+    """
+    p = HHParams() if params is None else params
+    comp = _Compartments(cell.sections, Ra, cm, lambdaF)
+    n = len(comp)
+    areaCm2 = comp.area * 1e-8
+    C = cm * areaCm2 * 1e3  # nF
+    hh = np.array([mech == 'hh' for mech in comp.mechanism])
+    # maximal conductances (μS) of each compartment, zero where absent
+    gNaMax = np.where(hh, p.gbarNa * 1e-3, 0) * areaCm2 * 1e6
+    gKMax = np.where(hh, p.gbarK * 1e-3, 0) * areaCm2 * 1e6
+    gLeak = np.where(hh, p.gbarl * 1e-3, 0) * areaCm2 * 1e6
+    gLeakE = gLeak * p.El
+    if passive is not None:
+        gPas = passive[0] * areaCm2 * 1e6
+        gLeakE = gLeakE + gPas * passive[1]
+        gLeak = gLeak + gPas
+
+    # constant part of the tree matrix
+    d0 = C / dt
+    np.add.at(d0, comp.edgeChild, comp.edgeG)
+    np.add.at(d0, comp.edgeParent, comp.edgeG)
+    b = np.zeros(n)
+    b[comp.edgeChild] = -comp.edgeG
+    b = b.tolist()
+    parent = comp.parent.tolist()
+
+    stimIdx = comp.index(stimulus.section, stimulus.x)
+    nt = int(round(tstop / dt)) + 1
+    t = np.arange(nt) * dt
+    V = np.empty((nt, n))
+    imem = np.empty((nt, n))
+
+    v = np.full(n, float(vInit))
+    am, bm, an, bn, ah, bh = hh_rates.rates(v)
+    m, nn, h = am / (am + bm), an / (an + bn), ah / (ah + bh)
+    V[0] = v
+    imem[0] = 0
+    for i in range(1, nt):
+        # gates: exponential Euler at the current voltage
+        am, bm, an, bn, ah, bh = hh_rates.rates(v)
+        s = am + bm
+        m = am / s + (m - am / s) * np.exp(-dt * s)
+        s = an + bn
+        nn = an / s + (nn - an / s) * np.exp(-dt * s)
+        s = ah + bh
+        h = ah / s + (h - ah / s) * np.exp(-dt * s)
+        # voltage: backward Euler with the updated conductances
+        gNa = gNaMax * m ** 3 * h
+        gK = gKMax * nn ** 4
+        Istim = stimulus.amp if stimulus.delay <= t[i] < stimulus.delay + stimulus.dur else 0
+        d = d0 + gNa + gK + gLeak
+        rhs = C / dt * v + gNa * p.ENa + gK * p.EK + gLeakE
+        rhs[stimIdx] += Istim
+        v = np.array(_hinesSolve(d.tolist(), b, rhs.tolist(), parent))
+        V[i] = v
+        # membrane current (capacitive + ionic) = axial current + stimulus
+        axial = comp.edgeG * (v[comp.edgeParent] - v[comp.edgeChild])
+        Im = np.zeros(n)
+        np.add.at(Im, comp.edgeChild, axial)
+        np.subtract.at(Im, comp.edgeParent, axial)
+        Im[stimIdx] += Istim
+        imem[i] = Im
+
+    # back to the natural order: sections in the cell order, increasing x
+    order = [i for sec in cell.sections for i in comp.sectionIdx[sec.name]]
+    return CableResult(
+        t=t,
+        V=V[:, order].T,
+        imem=imem[:, order].T,
+        segments=[comp.segments[i] for i in order],
+        area=comp.area[order],
+    )
@@ -0,0 +1,78 @@
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+
+from src.core.cable import CableStimulus, _hinesSolve, simulateCable
+
+
+def _section(name, nseg, L, diam, mechanism, parent=None, parentEnd=0, childEnd=0):
+    # same attributes as src.app.model.SectionModel
+    return SimpleNamespace(name=name, nseg=nseg, L=L, diam=diam, mechanism=mechanism,
+                           parentSec=parent, parentEnd=parentEnd, childEnd=childEnd)
+
+
+class CableTest(unittest.TestCase):
+
+    def setUp(self):
+        soma = _section('soma', 1, 25, 25, 'hh')
+        axon = _section('axon', 20, 1000, 2, 'hh', soma, parentEnd=1, childEnd=0)
+        dend = _section('dend', 5, 50, 2, 'pas', soma, parentEnd=0, childEnd=1)
+        self.cell = SimpleNamespace(sections=[soma, axon, dend])
+        self.stim = CableStimulus('soma', 0.5, amp=0.2, dur=10, delay=1)
+
+    def test_segments_order(self):
+        result = simulateCable(self.cell, self.stim, tstop=1, lambdaF=None)
+        self.assertEqual(len(result.segments), 26)
+        self.assertEqual(result.segments[0], ('soma', 0.5))
+        self.assertEqual(result.segments[1], ('axon', 0.025))
+        self.assertEqual(result.segments[-1], ('dend', 0.9))
+        self.assertEqual(result.V.shape, (26, len(result.t)))
+
+    def test_hines_solve(self):
+        # random tree in Hines order (each parent before its children)
+        rng = np.random.default_rng(0)
+        n = 30
+        parent = [-1] + [int(rng.integers(0, i)) for i in range(1, n)]
+        b = -rng.uniform(0.5, 2, n)
+        b[0] = 0
+        d = rng.uniform(0.1, 1, n)
+        for i in range(1, n):
+            d[i] -= b[i]
+            d[parent[i]] -= b[i]
+        A = np.diag(d)
+        for i in range(1, n):
+            A[i, parent[i]] = A[parent[i], i] = b[i]
+        rhs = rng.normal(size=n)
+        expected = np.linalg.solve(A, rhs)
+        np.testing.assert_allclose(_hinesSolve(d.tolist(), b.tolist(), rhs.tolist(), parent), expected, rtol=1e-12)
+
+    def test_passive_steady_state(self):
+        # sealed passive cable, current injected at its middle: analytic
+        # steady state V(x) - E = I ra λ cosh(x< / λ) cosh((L - x>) / λ) / sinh(L / λ)
+        L, diam, Ra, gPas, I = 1000., 2., 150., 1 / 30000, 0.1
+        cable = SimpleNamespace(sections=[_section('cable', 101, L, diam, 'pas')])
+        result = simulateCable(cable, CableStimulus('cable', 0.5, amp=I, dur=1000, delay=0),
+                               tstop=500, dt=1, Ra=Ra, passive=(gPas, -65), lambdaF=None)
+        lam = np.sqrt(diam / (4 * Ra * gPas)) * 1e2  # μm
+        ra = 4 * Ra / (np.pi * (diam * 1e-4) ** 2) * 1e-4  # Ω/μm
+        x = np.array([x for _, x in result.segments]) * L
+        lo, hi = np.minimum(x, L / 2), np.maximum(x, L / 2)
+        expected = I * 1e-6 * ra * lam * np.cosh(lo / lam) * np.cosh((L - hi) / lam) / np.sinh(L / lam)
+        np.testing.assert_allclose(result.V[:, -1] + 65, expected, rtol=1e-4)
+
+    def test_action_potential_propagates(self):
+        result = simulateCable(self.cell, self.stim, tstop=15)
+        axon = [i for i, (name, _) in enumerate(result.segments) if name == 'axon']
+        self.assertGreater(result.V[0].max(), 20)
+        self.assertGreater(result.V[axon[-1]].max(), 20)
+        self.assertGreater(np.argmax(result.V[axon[-1]]), np.argmax(result.V[axon[0]]))
+
+    def test_invalid_topology(self):
+        orphan = _section('orphan', 1, 10, 1, 'pas', _section('missing', 1, 1, 1, None))
+        with self.assertRaises(ValueError):
+            simulateCable(SimpleNamespace(sections=[orphan]), CableStimulus('orphan'))
+
+
+if __name__ == '__main__':
+    unittest.main()
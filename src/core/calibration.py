@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module fits the free parameters of the fast simulation (the axonal
+sampling ``dk``, the upsampling factor ``taus`` of the filters, the
+amplitude ``Cs`` of the somatic dipole and the overall gain) against a
+reference simulation (LFPy), and stores the fitted values per morphology so
+that later runs need no reference. The stored calibrations are keyed by the
+morphology, the sources of the simulation, the options of the HH template
+and the candidate parameters, so changing any of them calibrates again.
+
+For a given ``(dk, taus)``, the potential of every electrode is linear in
+``Cs`` and in the gain, which are solved in closed form; the ``taus``
+candidates of a ``dk`` are evaluated in batches, over all electrodes at
+once.
+
+@author: Loïc Bertrand, Tony Zhou
+"""
+import dataclasses
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+from src.core import hh_rates, hhrun, morphofiltd, util
+from src.core.morphofiltd import chunks
+
+DEFAULT_DIRECTORY = util.cacheDirectory('calibration')
+BATCH_SIZE = 2 ** 24  # maximum number of basis values evaluated at once
+DKS = (5, 10, 20)  # default candidate axonal samplings (μm)
+TAUS_RANGE = range(5, 51)  # default candidate upsampling factors
+
+
+@dataclass
+class FilterCalibration:
+    dk: float  # axonal spatial sampling (μm)
+    taus: int  # upsampling factor of the filters
+    CsPerAmp: float  # somatic dipole amplitude per nA of stimulation
+    gain: float  # factor from the filtered current to the reference potential
+    error: float  # relative squared error against the reference
+
+
+def windowBasis(Im: np.ndarray, order: int, taus: np.ndarray, offset: int, length: int) -> np.ndarray:
+    """
+    Potential of a unit weight on each tap of the filters, in the window
+    compared to the reference: ``Vel[:, intervVm]`` of the demo is
+    ``w @ basis``.
+
+    :param Im:      membrane current (nA)
+    :param order:   filter length
+    :param taus:    upsampling factors (T)
+    :param offset:  index of the peak of ``Vm`` minus index of the peak of
+        the reference membrane voltage
+    :param length:  length of the window
+    :return:        basis of each upsampling factor (T x order x length)
+    """
+    taus = np.asarray(taus)[:, None, None]
+    k = np.arange(order)[None, :, None]
+    n = np.arange(length)[None, None, :]
+    Lw = order * taus
+    # 'same' convolution, cut from offset - Lw / 2
+    idx = offset - Lw // 2 + (Lw - 1) // 2 + n - k * taus
+    valid = (idx >= 0) & (idx < len(Im))
+    return np.where(valid, Im[np.clip(idx, 0, len(Im) - 1)], 0)
+
+
+def calibrate(unitFilters: Callable[[float], np.ndarray], Im: np.ndarray, Vref: np.ndarray,
+              offset: int, amp: float, dks: Iterable[float] = DKS,
+              tausRange: Iterable[int] = TAUS_RANGE) -> FilterCalibration:
+    """
+    Finds the parameters of the fast simulation which best match a
+    reference simulation, in the least squares sense over all electrodes.
+
+    :param unitFilters: function giving the filters of the electrodes for
+        ``Cs = 1`` at a given ``dk`` (M x order)
+    :param Im:          membrane current template (nA)
+    :param Vref:        reference extracellular potentials (M x length)
+    :param offset:      index of the peak of ``Vm`` minus index of the peak
+        of the reference membrane voltage
+    :param amp:         amplitude of the stimulation of the reference (nA)
+    :param dks:         candidate axonal samplings (μm)
+    :param tausRange:   candidate upsampling factors
+    :return:            the best parameters
+    """
+    Y = np.asarray(Vref, dtype=float)
+    M, length = Y.shape
+    yy = (Y ** 2).sum()
+    taus = np.asarray(list(tausRange))
+    best = None
+    for dk in dks:
+        w = unitFilters(dk)
+        order = w.shape[1]
+        for start, stop in chunks(len(taus), max(1, BATCH_SIZE // (order * length))):
+            B = windowBasis(Im, order, taus[start:stop], offset, length)
+            S = w[None, :, :1] * B[:, None, 0]  # somatic potentials (T x M x length)
+            A = w[None, :, 1:] @ B[:, 1:]  # axonal potentials
+            ss, sa, aa = (S * S).sum(axis=(1, 2)), (S * A).sum(axis=(1, 2)), (A * A).sum(axis=(1, 2))
+            ys, ya = (Y * S).sum(axis=(1, 2)), (Y * A).sum(axis=(1, 2))
+            # V = a S + b A, b being the gain and a / b the somatic amplitude
+            with np.errstate(divide='ignore', invalid='ignore'):
+                det = ss * aa - sa ** 2
+                a = (aa * ys - sa * ya) / det
+                b = (ss * ya - sa * ys) / det
+                error = (yy - a * ys - b * ya) / yy
+            error = np.where(np.isfinite(error), error, np.inf)
+            i = np.argmin(error)
+            if best is None or error[i] < best.error:
+                best = FilterCalibration(dk=float(dk), taus=int(taus[start + i]),
+                                         CsPerAmp=float(a[i] / b[i] / amp), gain=float(b[i]),
+                                         error=float(error[i]))
+    if best is None:
+        raise ValueError('no candidate parameters')
+    return best
+
+
+def _sourceHash() -> str:
+    digest = hashlib.sha256()
+    for path in (__file__, morphofiltd.__file__, hhrun.__file__, hh_rates.__file__):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class CalibrationStore:
+    """
+    Calibrations stored as JSON files, one per morphology and simulation
+    setup (see ``key``)
+    """
+
+    def __init__(self, directory: Path = DEFAULT_DIRECTORY):
+        self.directory = Path(directory)
+
+    @staticmethod
+    def key(morphology: str, **params) -> str:
+        """
+        :param morphology:  identifier of the morphology
+        :param params:      JSON-serializable parameters the calibration
+            depends on (options of the HH template, stimulation, candidate
+            ``dks`` and ``tausRange``)
+        :return:            key of the calibration, which also depends on the
+            sources of the simulation
+        """
+        params = {name: list(value) if isinstance(value, (range, tuple)) else value
+                  for name, value in params.items()}
+        return util.contentKey(morphology=morphology, source=_sourceHash(), **params)
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f'{key}.json'
+
+    def get(self, key: str) -> Optional[FilterCalibration]:
+        """
+        :param key:     key of the calibration (see ``key``)
+        :return:        the calibration, or ``None``
+        """
+        try:
+            with open(self._path(key)) as f:
+                return FilterCalibration(**json.load(f))
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def put(self, key: str, calibration: FilterCalibration):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._path(key)
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(dataclasses.asdict(calibration), f, indent=2)
+        os.replace(tmp, path)
+
+
+DEFAULT_STORE = CalibrationStore()
@@ -0,0 +1,61 @@
+import tempfile
+import unittest
+
+import numpy as np
+
+from src.core.calibration import CalibrationStore, calibrate
+from src.core.convolution import convolveElectrodes
+from src.core.morphofiltd import morphofiltd
+
+
+class CalibrationTest(unittest.TestCase):
+
+    def setUp(self):
+        x, y = np.meshgrid(np.linspace(-100, 500, 7), np.linspace(-100, 100, 3))
+        self.re = np.stack([x.ravel(), y.ravel(), np.full(x.size, 25.)], axis=1)
+        t = np.arange(4000)
+        self.Im = np.exp(-((t - 1000) / 40) ** 2) - 0.5 * np.exp(-((t - 1100) / 80) ** 2)
+
+    def unitFilters(self, dk):
+        AL = 400
+        return morphofiltd(self.re, int(AL / dk + 1), np.zeros(3), np.array([12.5, 0, 0]),
+                           np.array([12.5 + AL - dk, 0, 0]), np.array([-12.5, 0, 0]))
+
+    def test_calibrate_recovers_parameters(self):
+        # reference built like the demo: convolution, cut, gain
+        dk, taus, amp, Cs, gain = 10, 17, 0.2, 3, 40
+        w = self.unitFilters(dk)
+        w[:, 0] *= Cs
+        Vel = convolveElectrodes(self.Im, w, taus)
+        offset, length = 1200, 1500
+        rangeStart = offset - int(np.fix(w.shape[1] * taus / 2))
+        Vref = gain * Vel[:, rangeStart:rangeStart + length]
+
+        calibration = calibrate(self.unitFilters, self.Im, Vref, offset, amp,
+                                dks=(5, 10, 20), tausRange=range(10, 25))
+        self.assertEqual((calibration.dk, calibration.taus), (dk, taus))
+        self.assertAlmostEqual(calibration.CsPerAmp, Cs / amp)
+        self.assertAlmostEqual(calibration.gain, gain)
+        self.assertLess(calibration.error, 1e-12)
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = CalibrationStore(directory)
+            self.assertIsNone(store.get('cell'))
+            store.put('cell', calibration)
+            self.assertEqual(store.get('cell'), calibration)
+
+    def test_store_key(self):
+        key = CalibrationStore.key('cell', method='rush_larsen', stride=10, dur=30, delay=1,
+                                   dks=(5, 10), tausRange=range(5, 51))
+        self.assertEqual(key, CalibrationStore.key('cell', delay=1, dur=30, method='rush_larsen', stride=10,
+                                                   dks=[5, 10], tausRange=list(range(5, 51))))
+        self.assertNotEqual(key, CalibrationStore.key('cell', method='euler', stride=10, dur=30, delay=1,
+                                                      dks=(5, 10), tausRange=range(5, 51)))
+        self.assertNotEqual(key, CalibrationStore.key('cell', method='rush_larsen', stride=10, dur=30, delay=1,
+                                                      dks=(5, 10), tausRange=range(5, 41)))
+        self.assertNotEqual(key, CalibrationStore.key('other', method='rush_larsen', stride=10, dur=30, delay=1,
+                                                      dks=(5, 10), tausRange=range(5, 51)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the convolution stage of the fast simulation: the
+membrane current of the soma is convolved with the morphological filter of
+each electrode (see ``morphofiltd``), upsampled by ``taus``, to give the
+extracellular potentials.
+
+@author: Loïc Bertrand, Tony Zhou
+"""
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from src.core.morphofiltd import chunks
+
+
+def upsampleFilters(w: np.ndarray, taus: int) -> np.ndarray:
+    """
+    Upsamples the filters of each electrode, like ``util.upsample(w.T, taus).T``.
+
+    :param w:       filters (M x order)
+    :param taus:    integer factor
+    :return:        upsampled filters (M x order * taus)
+    """
+    if taus <= 0:
+        raise ValueError('value taus must be positive: ' + str(taus))
+    wup = np.zeros((w.shape[0], w.shape[1] * taus), dtype=w.dtype)
+    wup[:, ::taus] = w
+    return wup
+
+
+def convolveElectrodes(Im: np.ndarray, w: np.ndarray, taus: int,
+                       chunkSize: Optional[int] = None,
+                       out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Computes the extracellular potential of each electrode:
+    ``np.convolve(Im, wup[iel], 'same')``, ``wup`` being the filters
+    upsampled by ``taus``.
+
+    Electrodes are processed in blocks of ``chunkSize``, the upsampled
+    filters of a single block being held in memory at once, so with a
+    memory-mapped ``w`` and ``out`` the memory used does not depend on the
+    number of electrodes.
+
+    :param Im:          membrane current (nA)
+    :param w:           filters of the electrodes (M x order)
+    :param taus:        upsampling factor of the filters
+    :param chunkSize:   number of electrodes processed at once (default: all)
+    :param out:         preallocated (M x len(Im)) result, e.g. a
+        ``numpy.memmap`` (default: a new array)
+    :return:            extracellular potentials (M x len(Im))
+    """
+    M = w.shape[0]
+    if out is None:
+        out = np.empty((M, len(Im)))
+    elif out.shape != (M, len(Im)):
+        raise ValueError(f'out must be of shape {(M, len(Im))}: {out.shape}')
+    for start, stop in chunks(M, chunkSize):
+        wup = upsampleFilters(np.asarray(w[start:stop]), taus)
+        for iel in range(stop - start):
+            out[start + iel] = np.convolve(Im, wup[iel], 'same')
+    return out
+
+
+def fastLength(n: int) -> int:
+    """
+    Smallest 5-smooth integer (of the form 2^a 3^b 5^c) greater than or
+    equal to ``n``: the FFT is fastest for these lengths.
+
+    >>> fastLength(1001)
+    1024
+    >>> fastLength(1100)
+    1125
+    """
+    if n <= 1:
+        return 1
+    best = 1 << (n - 1).bit_length()
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            # smallest power of 2 bringing p35 to n or above
+            p = p35 << max(0, (-(-n // p35) - 1).bit_length())
+            best = min(best, p)
+            p35 *= 3
+        p5 *= 5
+    return best
+
+
+def convolveElectrodesFFT(Im: np.ndarray, w: np.ndarray, taus: int,
+                          chunkSize: Optional[int] = None,
+                          out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Same as ``convolveElectrodes``, computed in the frequency domain: ``Im``
+    is transformed once, then multiplied by the spectra of the upsampled
+    filters of a whole block of electrodes and transformed back in a single
+    batched operation. The transform length is the smallest 5-smooth length
+    holding the full convolution (see ``fastLength``).
+
+    The result equals the direct convolution up to the rounding error of the
+    FFT (relative to the largest potential of each electrode).
+
+    :param Im:          membrane current (nA), at least ``order * taus`` long
+    :param w:           filters of the electrodes (M x order)
+    :param taus:        upsampling factor of the filters
+    :param chunkSize:   number of electrodes transformed at once (default: all)
+    :param out:         preallocated (M x len(Im)) result, e.g. a
+        ``numpy.memmap`` (default: a new array)
+    :return:            extracellular potentials (M x len(Im))
+    """
+    M, order = w.shape
+    N = len(Im)
+    L = order * taus
+    if N < L:
+        raise ValueError(f'Im must be at least {L} samples long: {N}')
+    if out is None:
+        out = np.empty((M, N))
+    elif out.shape != (M, N):
+        raise ValueError(f'out must be of shape {(M, N)}: {out.shape}')
+    n = fastLength(N + L - 1)
+    spectrum = np.fft.rfft(Im, n)
+    # 'same' keeps the full convolution from the center of the filter
+    center = (L - 1) // 2
+    for start, stop in chunks(M, chunkSize):
+        wup = upsampleFilters(np.asarray(w[start:stop]), taus)
+        full = np.fft.irfft(np.fft.rfft(wup, n, axis=1) * spectrum, n, axis=1)
+        out[start:stop] = full[:, center:center + N]
+    return out
+
+
+def antiAliasFilter(decimation: int) -> np.ndarray:
+    """
+    Low-pass FIR filter applied before keeping one sample out of
+    ``decimation``, like ``scipy.signal.decimate(..., ftype='fir')``:
+    Hamming-windowed sinc of ``20 * decimation + 1`` taps, cut at the
+    Nyquist frequency of the decimated signal, with unit gain at 0 Hz.
+
+    :param decimation:  decimation factor
+    :return:            taps of the filter (symmetric, odd length)
+    """
+    if decimation <= 0:
+        raise ValueError('decimation must be positive: ' + str(decimation))
+    half = 10 * decimation
+    h = np.sinc(np.arange(-half, half + 1) / decimation) * np.hamming(2 * half + 1)
+    return h / h.sum()
+
+
+def _lowpass(x: np.ndarray, decimation: int, axis: int = -1, mode: str = 'constant') -> np.ndarray:
+    """
+    Filters ``x`` with ``antiAliasFilter(decimation)`` along ``axis``, the
+    output being aligned with (and as long as) the input. ``x`` is extended
+    beyond its ends with the ``numpy.pad`` ``mode``: zeros by default, as
+    in the ``'same'`` convolution, or ``'edge'`` for signals with an offset.
+    """
+    if decimation == 1:
+        return x
+    h = antiAliasFilter(decimation)
+    half = (len(h) - 1) // 2
+    return np.apply_along_axis(lambda row: np.convolve(np.pad(row, half, mode=mode), h, 'valid'), axis, x)
+
+
+def decimate(x: np.ndarray, decimation: int, axis: int = -1) -> np.ndarray:
+    """
+    Anti-aliased decimation: keeps one sample out of ``decimation`` of
+    ``x`` filtered by ``antiAliasFilter``, without delay. The signals are
+    extended with their first and last values, so that an offset does not
+    fade at the ends.
+
+    :param x:           signals
+    :param decimation:  decimation factor
+    :param axis:        time axis of ``x``
+    :return:            decimated signals
+    """
+    if decimation <= 0:
+        raise ValueError('decimation must be positive: ' + str(decimation))
+    x = _lowpass(np.asarray(x, dtype=float), decimation, axis, mode='edge')
+    return np.take(x, np.arange(0, x.shape[axis], decimation), axis=axis)
+
+
+def convolvePolyphase(Im: np.ndarray, w: np.ndarray, taus: int,
+                      chunkSize: Optional[int] = None,
+                      out: Optional[np.ndarray] = None,
+                      window: Optional[Tuple[int, int]] = None,
+                      decimation: int = 1) -> np.ndarray:
+    """
+    Same as ``convolveElectrodes``, without upsampling the filters: only one
+    sample of ``Im`` out of ``taus`` meets a nonzero weight of ``wup``, so
+    each output sample is the product of the compact filter with a strided
+    window of ``Im``. All the windows are views of a single padded copy of
+    ``Im`` and a block of electrodes is computed by one matrix product,
+    ``taus`` times fewer multiply-adds than the direct convolution.
+
+    With ``window = (start, stop)``, only the output samples
+    ``start:stop`` are computed, from the span of ``Im`` they depend on:
+    the result equals ``convolveElectrodes(Im, w, taus)[:, start:stop]``.
+    The window may extend beyond the ends of ``Im``, the convolution being
+    continued with ``Im`` zero outside of its samples.
+
+    With ``decimation = q``, only the samples ``start, start + q, ...`` of
+    the window are computed, ``Im`` being low-pass filtered beforehand (see
+    ``antiAliasFilter``): the filtering commutes with the convolution, so
+    the result equals ``decimate`` applied to the potentials, except within
+    ``10 * q`` samples of the ends of ``Im``, and costs q times less.
+
+    :param Im:          membrane current (nA)
+    :param w:           filters of the electrodes (M x order)
+    :param taus:        upsampling factor of the filters
+    :param chunkSize:   number of electrodes processed at once (default: all)
+    :param out:         preallocated (M x T) result, e.g. a
+        ``numpy.memmap`` (default: a new array)
+    :param window:      range of output samples to compute (default: all,
+        ``(0, len(Im))``)
+    :param decimation:  decimation factor of the output
+    :return:            extracellular potentials (M x T), T being
+        ``ceil((stop - start) / decimation)``
+    """
+    if taus <= 0:
+        raise ValueError('value taus must be positive: ' + str(taus))
+    if decimation <= 0:
+        raise ValueError('decimation must be positive: ' + str(decimation))
+    M, order = w.shape
+    start, stop = (0, len(Im)) if window is None else window
+    if stop < start:
+        raise ValueError(f'window must be an increasing range: {window}')
+    T = -(-(stop - start) // decimation)
+    if out is None:
+        out = np.empty((M, T))
+    elif out.shape != (M, T):
+        raise ValueError(f'out must be of shape {(M, T)}: {out.shape}')
+    windows = _polyphaseWindows(_lowpass(Im, decimation), order, taus, start, T, decimation)
+    for first, last in chunks(M, chunkSize):
+        out[first:last] = np.asarray(w[first:last])[:, ::-1] @ windows
+    return out
+
+
+def _polyphaseWindows(Im: np.ndarray, order: int, taus: int, start: int, count: int,
+                      step: int = 1) -> np.ndarray:
+    """
+    :return:    (order x count) view whose column ``j`` holds the samples
+        ``Im[n + center - k * taus]`` met by the taps
+        ``k = order - 1, ..., 0`` of the upsampled filters for the output
+        sample ``n = start + j * step`` of the ``'same'`` convolution (zero
+        outside of ``Im``)
+    """
+    L = order * taus
+    center = (L - 1) // 2
+    # first sample used, for the output sample start and the last tap
+    first = start + center - (order - 1) * taus
+    length = max(count - 1, 0) * step + 1 + (order - 1) * taus
+    lo, hi = max(first, 0), min(first + length, len(Im))
+    padded = np.zeros(length)
+    if lo < hi:
+        padded[lo - first:hi - first] = Im[lo:hi]
+    itemSize = padded.strides[0]
+    return np.lib.stride_tricks.as_strided(padded, shape=(order, count),
+                                           strides=(taus * itemSize, step * itemSize), writeable=False)
+
+
+@dataclass
+class LowRankFilters:
+    """
+    Filters of the electrodes factorised as ``coefficients @ basis``
+    (truncated SVD of the filter bank)
+    """
+    basis: np.ndarray  # r basis filters (r x order)
+    coefficients: np.ndarray  # weight of each basis filter at each electrode (M x r)
+    # relative Frobenius norm of the dropped part of the filter bank
+    error: float
+    # l1 norm of the dropped part of the filter of each electrode: the
+    # potential of electrode i differs from the full rank one by at most
+    # errorBound[i] * max|Im|
+    errorBound: np.ndarray
+
+    @property
+    def rank(self) -> int:
+        return len(self.basis)
+
+    def toDense(self) -> np.ndarray:
+        return self.coefficients @ self.basis
+
+
+def lowRankFilters(w: np.ndarray, tol: float) -> LowRankFilters:
+    """
+    Factorises the filters of the electrodes into the smallest number of
+    basis filters keeping the relative Frobenius error below ``tol`` (the
+    dropped singular values holding at most ``tol ** 2`` of the energy of
+    the filter bank). Neighbouring electrodes have very similar filters, so
+    dense grids only need a few basis filters.
+
+    :param w:       filters of the electrodes (M x order)
+    :param tol:     relative tolerance, between 0 and 1
+    :return:        the factorised filters, with the error introduced
+    """
+    if not 0 <= tol < 1:
+        raise ValueError('tol must be in [0, 1): ' + str(tol))
+    w = np.asarray(w)
+    U, S, Vt = np.linalg.svd(w, full_matrices=False)
+    energy = np.cumsum(S[::-1] ** 2)[::-1]  # energy of S[r:] for each r
+    total = energy[0] if len(energy) else 0
+    dropped = energy <= tol ** 2 * total
+    rank = int(np.argmax(dropped)) if dropped.any() else len(S)
+    residual = np.sqrt(energy[rank] / total) if rank < len(S) and total > 0 else 0.
+    coefficients = U[:, :rank] * S[:rank]
+    basis = Vt[:rank]
+    return LowRankFilters(basis, coefficients, float(residual),
+                          np.abs(w - coefficients @ basis).sum(axis=1))
+
+
+def convolveLowRank(Im: np.ndarray, filters: LowRankFilters, taus: int,
+                    out: Optional[np.ndarray] = None,
+                    window: Optional[Tuple[int, int]] = None,
+                    decimation: int = 1) -> np.ndarray:
+    """
+    Same as ``convolvePolyphase`` for factorised filters (see
+    ``lowRankFilters``): ``Im`` is convolved with the r basis filters only,
+    the potentials of the M electrodes being their combination by one
+    matrix product.
+
+    :param Im:      membrane current (nA)
+    :param filters: factorised filters of the electrodes
+    :param taus:    upsampling factor of the filters
+    :param out:     preallocated (M x stop - start) result (default: a new array)
+    :param window:  range of output samples to compute (default: all)
+    :param decimation:  decimation factor of the output
+    :return:        extracellular potentials (M x T), see ``convolvePolyphase``
+    """
+    basisVel = convolvePolyphase(Im, filters.basis, taus, window=window, decimation=decimation)
+    M = len(filters.coefficients)
+    if out is None:
+        out = np.empty((M, basisVel.shape[1]))
+    elif out.shape != (M, basisVel.shape[1]):
+        raise ValueError(f'out must be of shape {(M, basisVel.shape[1])}: {out.shape}')
+    np.matmul(filters.coefficients, basisVel, out=out)
+    return out
+
+
+def convolvePopulation(Ims: np.ndarray, W: np.ndarray, taus: int,
+                       chunkSize: Optional[int] = None,
+                       out: Optional[np.ndarray] = None,
+                       window: Optional[Tuple[int, int]] = None,
+                       decimation: int = 1) -> np.ndarray:
+    """
+    Computes the extracellular potential of a population of C cells at each
+    electrode: the sum over the cells of ``convolvePolyphase(Ims[c], W[c])``.
+    When the cells share a single template, the convolution is linear in
+    the filters, so their sum is convolved once.
+
+    :param Ims:         membrane current of each cell (C x N), or a single
+        template shared by the cells (N)
+    :param W:           filters of each cell at each electrode (C x M x order),
+        see ``morphofiltdPopulation``
+    :param taus:        upsampling factor of the filters
+    :param chunkSize:   number of electrodes processed at once (default: all)
+    :param out:         preallocated (M x T) result (default: a new array)
+    :param window:      range of output samples to compute (default: all,
+        ``(0, N)``)
+    :param decimation:  decimation factor of the output
+    :return:            extracellular potentials (M x T), T being
+        ``ceil((stop - start) / decimation)``
+    """
+    Ims = np.asarray(Ims)
+    if Ims.ndim == 1 or len(Ims) == 1:
+        return convolvePolyphase(Ims.ravel(), np.sum(W, axis=0), taus, chunkSize, out, window, decimation)
+    C = len(W)
+    if len(Ims) != C:
+        raise ValueError(f'Ims must hold one template per cell ({C}): {len(Ims)}')
+    out = convolvePolyphase(Ims[0], W[0], taus, chunkSize, out, window, decimation)
+    for c in range(1, C):
+        out += convolvePolyphase(Ims[c], W[c], taus, chunkSize, window=window, decimation=decimation)
+    return out
+
+
+@dataclass
+class FilterGroup:
+    """
+    Filters of the electrodes sharing the same axial resolution: the axon
+    taps are summed by blocks of ``factor`` compartments, each sum being
+    applied at the central tap of its block
+    """
+    factor: int
+    rows: np.ndarray  # electrodes of the group
+    taps: np.ndarray  # tap of each column (0 for the soma)
+    weights: np.ndarray  # (len(rows) x len(taps))
+    # l2 norm of the difference between the potential of each electrode and
+    # the one of its full resolution filter, relative to the l2 norm of the
+    # latter, for the membrane current given to ``adaptiveFilters``
+    error: np.ndarray
+
+
+def _coarsenFilters(w: np.ndarray, factor: int):
+    """
+    :return:    taps and weights of the filters coarsened by ``factor``, and
+        their difference with the full resolution filters (M x order)
+    """
+    axon = w[:, 1:]
+    n = axon.shape[1]
+    starts = np.arange(0, n, factor)
+    lengths = np.diff(np.append(starts, n))
+    sums = np.add.reduceat(axon, starts, axis=1)
+    centers = starts + (lengths - 1) // 2
+    difference = np.array(w, dtype=float)
+    difference[:, 0] = 0
+    difference[:, 1 + centers] -= sums
+    return np.concatenate([[0], 1 + centers]), np.concatenate([w[:, :1], sums], axis=1), difference
+
+
+def adaptiveFilters(w: np.ndarray, Im: np.ndarray, taus: int, tol: float,
+                    factors=(1, 3, 9, 27)) -> List[FilterGroup]:
+    """
+    Gives each electrode the coarsest axial resolution whose potential
+    differs from the full resolution one by at most ``tol`` in relative l2
+    norm (energy). The field of the axon varies on a length scale which
+    grows with the distance to the electrode, so distant electrodes may keep
+    only a few taps. Electrodes are grouped by resolution, each group being
+    convolved in one batch by ``convolveAdaptive``.
+
+    Moving the sum of a block to its central tap changes the filter by
+    ``difference`` (see ``_coarsenFilters``), which accounts for both the
+    variation of the filter within the block and the time shift of its
+    weights. The energy of a filter convolved with ``Im`` only depends on
+    the autocorrelation ``R`` of ``Im`` at the lags of the taps
+    (``d @ R @ d``, for the whole convolution), so the resolutions are
+    chosen from the filters without convolving them.
+
+    :param w:       filters of the electrodes (M x order)
+    :param Im:      membrane current (nA) the filters are used with
+    :param taus:    upsampling factor of the filters
+    :param tol:     relative tolerance on the potential of each electrode
+    :param factors: candidate numbers of compartments per tap (1 is always
+        used for the electrodes which need the full resolution)
+    :return:        groups of filters, by decreasing factor
+    """
+    w = np.asarray(w)
+    M, order = w.shape
+    R = _autocorrelation(Im, order, taus)
+    energy = np.einsum('mk,kl,ml->m', w, R, w)
+    remaining = np.arange(M)
+    groups = []
+    for factor in sorted(set(factors) - {1}, reverse=True):
+        taps, weights, difference = _coarsenFilters(w[remaining], factor)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            error = np.sqrt(np.maximum(np.einsum('mk,kl,ml->m', difference, R, difference), 0)
+                            / energy[remaining])
+        ok = error <= tol
+        if ok.any():
+            groups.append(FilterGroup(factor, remaining[ok], taps, weights[ok], error[ok]))
+            remaining = remaining[~ok]
+    if len(remaining):
+        groups.append(FilterGroup(1, remaining, np.arange(order), w[remaining], np.zeros(len(remaining))))
+    return groups
+
+
+def _autocorrelation(Im: np.ndarray, order: int, taus: int) -> np.ndarray:
+    """
+    :return:    (order x order) matrix ``R[k, l] = sum_n Im[n] Im[n + (k - l) * taus]``
+    """
+    n = fastLength(len(Im) + order * taus)
+    spectrum = np.fft.rfft(Im, n)
+    r = np.fft.irfft(spectrum * spectrum.conj(), n)[:order * taus:taus]
+    lags = np.arange(order)
+    return r[np.abs(lags[:, None] - lags[None])]
+
+
+def convolveAdaptive(Im: np.ndarray, groups: List[FilterGroup], shape: tuple, taus: int,
+                     out: Optional[np.ndarray] = None,
+                     window: Optional[Tuple[int, int]] = None,
+                     decimation: int = 1) -> np.ndarray:
+    """
+    Same as ``convolvePolyphase`` for filters grouped by resolution (see
+    ``adaptiveFilters``): each group is the product of its weights with the
+    rows of the polyphase windows of its taps, so the cost is proportional
+    to the number of taps kept for each electrode instead of ``M * order``.
+
+    :param Im:          membrane current (nA)
+    :param groups:      groups of filters
+    :param shape:       (M, order) of the dense filters
+    :param taus:        upsampling factor of the filters
+    :param out:         preallocated (M x T) result (default: a new array)
+    :param window:      range of output samples to compute (default: all,
+        ``(0, len(Im))``)
+    :param decimation:  decimation factor of the output
+    :return:            extracellular potentials (M x T), T being
+        ``ceil((stop - start) / decimation)``
+    """
+    if taus <= 0:
+        raise ValueError('value taus must be positive: ' + str(taus))
+    if decimation <= 0:
+        raise ValueError('decimation must be positive: ' + str(decimation))
+    M, order = shape
+    start, stop = (0, len(Im)) if window is None else window
+    if stop < start:
+        raise ValueError(f'window must be an increasing range: {window}')
+    T = -(-(stop - start) // decimation)
+    if out is None:
+        out = np.empty((M, T))
+    elif out.shape != (M, T):
+        raise ValueError(f'out must be of shape {(M, T)}: {out.shape}')
+    # row order - 1 - k of the windows is met by the tap k
+    windows = _polyphaseWindows(_lowpass(Im, decimation), order, taus, start, T, decimation)
+    for group in groups:
+        out[group.rows] = group.weights @ windows[order - 1 - group.taps]
+    return out
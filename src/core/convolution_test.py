@@ -0,0 +1,174 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from src.core import util
+from src.core.convolution import (adaptiveFilters, antiAliasFilter, convolveAdaptive, convolveElectrodes,
+                                  convolveElectrodesFFT, convolveLowRank, convolvePolyphase, convolvePopulation,
+                                  decimate, fastLength, lowRankFilters)
+from src.core.hh_cache import computeTemplate
+from src.core.morphofiltd import morphofiltd
+
+
+class ConvolutionTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.re = rng.uniform(-500, 500, (23, 3))
+        self.geometry = (np.array([0, 0, 0]), np.array([12.5, 0, 0]), np.array([1002.5, 0, 0]))
+        self.w = morphofiltd(self.re, 11, *self.geometry)
+        self.Im = rng.normal(size=400)
+
+    def test_convolveElectrodes(self):
+        wup = util.upsample(self.w.T, 7).T
+        expected = np.array([np.convolve(self.Im, row, 'same') for row in wup])
+        assert_array_equal(convolveElectrodes(self.Im, self.w, 7), expected)
+        assert_array_equal(convolveElectrodes(self.Im, self.w, 7, chunkSize=5), expected)
+
+    def test_convolveElectrodesFFT(self):
+        # odd and even lengths of the signal and of the upsampled filters
+        for taus, Im in ((7, self.Im), (6, self.Im[:-1])):
+            expected = convolveElectrodes(Im, self.w, taus)
+            atol = 1e-12 * np.abs(expected).max()
+            assert_allclose(convolveElectrodesFFT(Im, self.w, taus), expected, rtol=0, atol=atol)
+            assert_allclose(convolveElectrodesFFT(Im, self.w, taus, chunkSize=5), expected, rtol=0, atol=atol)
+        self.assertEqual(fastLength(400 + 77 - 1), 480)
+        with self.assertRaises(ValueError):
+            convolveElectrodesFFT(self.Im[:50], self.w, 7)
+
+    def test_convolvePolyphase(self):
+        for taus, Im in ((7, self.Im), (6, self.Im[:-1]), (1, self.Im)):
+            expected = convolveElectrodes(Im, self.w, taus)
+            atol = 1e-13 * np.abs(expected).max()
+            assert_allclose(convolvePolyphase(Im, self.w, taus), expected, rtol=0, atol=atol)
+            assert_allclose(convolvePolyphase(Im, self.w, taus, chunkSize=5), expected, rtol=0, atol=atol)
+        with self.assertRaises(ValueError):
+            convolvePolyphase(self.Im, self.w, 0)
+
+    def test_convolvePolyphase_window(self):
+        expected = convolveElectrodes(self.Im, self.w, 7)
+        atol = 1e-13 * np.abs(expected).max()
+        # windows at both edges (zero padding) and in the middle
+        for window in ((0, 30), (150, 260), (390, 400), (200, 200)):
+            Vel = convolvePolyphase(self.Im, self.w, 7, chunkSize=5, window=window)
+            assert_allclose(Vel, expected[:, slice(*window)], rtol=0, atol=atol)
+        # windows beyond the ends of Im, which is zero outside of its samples
+        padded = convolveElectrodes(np.pad(self.Im, 100), self.w, 7)
+        for window in ((-60, 30), (390, 450), (-100, 500)):
+            Vel = convolvePolyphase(self.Im, self.w, 7, window=window)
+            assert_allclose(Vel, padded[:, window[0] + 100:window[1] + 100], rtol=0, atol=atol)
+        with self.assertRaises(ValueError):
+            convolvePolyphase(self.Im, self.w, 7, window=(30, 20))
+
+    def test_low_rank_filters(self):
+        x = np.linspace(-200, 1200, 30)
+        re = np.stack([np.tile(x, 3), np.zeros(90), np.repeat([50., 100., 150.], 30)], axis=1)
+        w = morphofiltd(re, 101, *self.geometry)
+        dense = convolvePolyphase(self.Im, w, 3)
+        exact = lowRankFilters(w, 0)
+        assert_allclose(exact.toDense(), w, rtol=0, atol=1e-12 * np.abs(w).max())
+        filters = lowRankFilters(w, 1e-2)
+        self.assertLess(filters.rank, 30)
+        self.assertLessEqual(filters.error, 1e-2)
+        self.assertAlmostEqual(filters.error, np.linalg.norm(w - filters.toDense()) / np.linalg.norm(w))
+        Vel = convolveLowRank(self.Im, filters, 3)
+        bound = filters.errorBound * np.abs(self.Im).max() * (1 + 1e-9) + 1e-12 * np.abs(dense).max()
+        self.assertTrue(np.all(np.abs(Vel - dense).max(axis=1) <= bound))
+        assert_allclose(convolveLowRank(self.Im, filters, 3, window=(100, 200)), Vel[:, 100:200],
+                        rtol=0, atol=1e-13 * np.abs(dense).max())
+        with self.assertRaises(ValueError):
+            lowRankFilters(w, 1)
+
+    def test_decimation(self):
+        h = antiAliasFilter(4)
+        self.assertEqual(len(h), 81)
+        self.assertAlmostEqual(h.sum(), 1)
+        # the band above the decimated Nyquist frequency is attenuated
+        response = np.abs(np.fft.rfft(h, 4096))
+        self.assertTrue(np.all(response[int(4096 * 0.16):] < 1e-2))
+        Im = np.tile(self.Im, 3)
+        full = convolveElectrodes(Im, self.w, 7)
+        expected = decimate(full, 4)
+        self.assertEqual(expected.shape, (len(self.w), 300))
+        atol = 1e-12 * np.abs(full).max()
+        Vel = convolvePolyphase(Im, self.w, 7, decimation=4)
+        assert_allclose(Vel[:, 20:-20], expected[:, 20:-20], rtol=0, atol=atol)
+        Vel = convolvePolyphase(Im, self.w, 7, window=(400, 797), decimation=4, chunkSize=5)
+        assert_allclose(Vel, expected[:, 100:200], rtol=0, atol=atol)
+        filters = lowRankFilters(self.w, 0)
+        assert_allclose(convolveLowRank(Im, filters, 7, window=(400, 797), decimation=4), Vel,
+                        rtol=0, atol=atol)
+        with self.assertRaises(ValueError):
+            convolvePolyphase(Im, self.w, 7, decimation=0)
+        # an offset is kept up to the ends of the decimated signals
+        offset = decimate(np.full((50, 2), 3.), 4, axis=0)
+        self.assertEqual(offset.shape, (13, 2))
+        assert_allclose(offset, 3)
+
+    def test_chunked_memmap(self):
+        with tempfile.TemporaryDirectory() as directory:
+            w = np.lib.format.open_memmap(os.path.join(directory, 'w.npy'), mode='w+',
+                                          shape=self.w.shape)
+            morphofiltd(self.re, 11, *self.geometry, chunkSize=4, out=w)
+            assert_array_equal(w, self.w)
+            Vel = np.lib.format.open_memmap(os.path.join(directory, 'Vel.npy'), mode='w+',
+                                            shape=(len(w), len(self.Im)))
+            convolveElectrodes(self.Im, w, 7, chunkSize=4, out=Vel)
+            assert_array_equal(Vel, convolveElectrodes(self.Im, self.w, 7))
+            del w, Vel
+        with self.assertRaises(ValueError):
+            morphofiltd(self.re, 11, *self.geometry, out=np.empty((3, 11)))
+
+    def test_adaptive_filters(self):
+        x = np.linspace(-500, 1500, 21)
+        re = np.stack([np.tile(x, 3), np.zeros(63), np.repeat([20., 500., 2000.], 21)], axis=1)
+        w = morphofiltd(re, 101, *self.geometry)
+        # spike of the HH soma, sampled at 1 MHz
+        _, Im = computeTemplate(dur=1, delay=1, dt=1 / 1000, Nt=6000, method='rush_larsen', stride=10)
+        taus = 20
+        dense = convolveElectrodes(Im, w, taus)
+        exact = adaptiveFilters(w, Im, taus, 0)
+        self.assertEqual([g.factor for g in exact], [1])
+        assert_allclose(convolveAdaptive(Im, exact, w.shape, taus), dense, rtol=0, atol=1e-12 * np.abs(dense).max())
+        # the whole convolution, from Im padded with zeros
+        padded = np.pad(Im, 101 * taus)
+        full = convolveElectrodes(padded, w, taus)
+        for tol in (0.01, 0.05):
+            groups = adaptiveFilters(w, Im, taus, tol)
+            factors = np.ones(len(w))
+            error = np.zeros(len(w))
+            coarse = np.zeros(w.shape)
+            for group in groups:
+                factors[group.rows] = group.factor
+                error[group.rows] = group.error
+                coarse[group.rows[:, None], group.taps] = group.weights
+            self.assertGreater(factors.max(), 1)
+            self.assertLess(np.mean(factors == 1), 0.5)
+            # the error of every electrode is within its tolerance
+            actual = np.linalg.norm(convolveAdaptive(padded, groups, w.shape, taus) - full, axis=1) \
+                / np.linalg.norm(full, axis=1)
+            assert_allclose(actual, error, rtol=1e-6, atol=1e-12)
+            self.assertTrue(np.all(error <= tol))
+            # same windows and decimation as the polyphase convolution
+            assert_allclose(convolveAdaptive(Im, groups, w.shape, taus, window=(-20, 5000), decimation=3),
+                            convolvePolyphase(Im, coarse, taus, window=(-20, 5000), decimation=3),
+                            rtol=1e-12, atol=1e-12 * np.abs(dense).max())
+
+    def test_convolvePopulation(self):
+        W = np.stack([self.w, 2 * self.w[::-1]])
+        Ims = np.stack([self.Im, self.Im[::-1]])
+        expected = convolveElectrodes(Ims[0], W[0], 7) + convolveElectrodes(Ims[1], W[1], 7)
+        assert_allclose(convolvePopulation(Ims, W, 7, chunkSize=6), expected)
+        expected = convolvePolyphase(Ims[0], W[0], 7, window=(-5, 390), decimation=2) \
+            + convolvePolyphase(Ims[1], W[1], 7, window=(-5, 390), decimation=2)
+        assert_allclose(convolvePopulation(Ims, W, 7, window=(-5, 390), decimation=2), expected)
+        # a single template is shared by the cells
+        assert_allclose(convolvePopulation(self.Im, W, 7), convolvePopulation(np.stack([self.Im] * 2), W, 7))
+        with self.assertRaises(ValueError):
+            convolvePopulation(np.stack([self.Im] * 3), W, 7)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,25 +3,26 @@
 """
 @author: Loïc Bertrand, Steven Le Cam, Radu Ranta, Tony Zhou
 """
-from typing import Dict
+from typing import Dict, Optional
 
 import LFPy
 import matplotlib.pyplot as plt
 import numpy as np
-from numpy import pi
-from numpy.linalg import norm
 
 from src.app import section_util
-from src.core import util
-from src.core.hhrun import hhrun
+from src.core import convolution, hh_cache, util
+from src.core.calibration import DEFAULT_STORE as calibrations, DKS, TAUS_RANGE, calibrate
+from src.core.hhrun import SpikeStop
 from src.core.lfpy_simulation import plotNeuron, plotStimulation, runLfpySimulation, ElectrodeRanges
-from src.core.morphofiltd import morphofiltd
+from src.core.filter_cache import cachedMorphofiltdPath
 
 
 def executeDemo(cell: LFPy.Cell,
                 stim: LFPy.StimIntElectrode,
                 stimParams: Dict[str, float],
-                elecRanges: ElectrodeRanges):
+                elecRanges: ElectrodeRanges,
+                rankTol: Optional[float] = None,
+                outputRate: Optional[float] = None):
     """
     Executes the demo comparing LFPy's simulation and Tran's fast simulation
     based on a morphological filtering approximation.
@@ -30,6 +31,14 @@ def executeDemo(cell: LFPy.Cell,
     :param stim:        LFPy.StimIntElectrode object
     :param stimParams:  parameters of the stimulation as a dictionary
     :param elecRanges:  electrode grid as numpy arrays
+    :param rankTol:     if set, the filters are factorised into a low-rank
+        basis with this relative tolerance (see ``lowRankFilters``)
+    :param outputRate:  if set, sampling rate (kHz) of the extracellular
+        potentials, e.g. 30 for a recording probe: the filter stage
+        produces them directly at this rate (anti-aliased decimation). The
+        decimation factor is rounded to an integer, so the actual rate is
+        ``1 / (dt * decimation)`` (30 kHz gives 30.3 kHz with dt = 1 μs),
+        which is printed and used for the time axis
     """
 
     # -----------------------------------------------------------
@@ -65,26 +74,19 @@ def executeDemo(cell: LFPy.Cell,
     lVLFPy = len(Vlfpy)  # signal length in LFPy
     dt = 1 / 1000  # sampling period in ms
     Nt = 2 ** 15
-    D = Nt * dt
-    t = util.closedRange(dt, D, dt) - dt
-
-    # fe = 1 / dt
-    # f = np.arange(0, fe / 2, fe / Nt)
 
     dur = stimParams.get('dur', 30)
     delay = stimParams.get('delay', 1)
-    I = (
-            (np.heaviside(t - delay, 1 / 2) - np.heaviside(t - dur - delay, 1 / 2))
-            * 0.044 / (2 * pi * 12.5 * 25) * 10 ** 8 * 10 ** -3
-        # * 5.093 # 0.15 / (pi * 12.5 * 12.5 * 2 + 2 * pi * 12.5 * 25) * 10 ** 8
-    )
-    # icur = 1
-
-    # pot membrane, proportional to ion channels electric current
-    # (http://www.bem.fi/book/03/03.htm, 3.14)
-    Vm, m, n, h, INa, IK, Il = hhrun(I, t)
 
-    Im = (INa + IK + Il) * (2 * pi * 12.5 * 25) / 10 ** 8 * 10 ** 3
+    # integrated with the exponential Euler scheme at hhStride * dt, then
+    # resampled at dt for the morphological filter. The template of the
+    # stimulation is cached on disk, so repeated runs skip this stage, and
+    # truncated once the samples used after the spike peak are reached.
+    hhMethod = 'rush_larsen'
+    hhStride = 10
+    stop = SpikeStop(after=(lVLFPy - inmvm) * dt)
+    Vm, Im = hh_cache.membraneTemplate(dur, delay, dt, Nt, method=hhMethod,
+                                       stride=hhStride, stop=stop)
     inMVm = np.argmax(Vm)
 
     # -----------------------------------------------------------
@@ -94,15 +96,10 @@ def executeDemo(cell: LFPy.Cell,
     dims = section_util.computeDimensions(cell.allseclist)
     print('picked up dimensions:', dims)
 
-    SL = dims.get('SL', 25)  # soma length (cylinder with the same diameter)
-
-    AL = dims.get('AL', 1000)  # axon length
     AD = dims.get('AD', 2)  # axon diameter
 
     LD = dims.get('LD', 200)  # dendrite length
     DD = dims.get('DD', 2)  # dendrite diameter
-    phi = pi / 2  # angle with Oz
-    theta = pi  # angle with Ox (phi=pi/2,theta=pi) indicates opposite to the axon
 
     # -----------------------------------------------------------
     # figure check
@@ -130,24 +127,33 @@ def executeDemo(cell: LFPy.Cell,
     # filter parameters
     # -----------------------------------------------------------
 
-    dk = 10  # axonal spatial sampling(~ nb of segments)
-
-    order = int(AL / dk + 1)
-    r0 = np.array([0, 0, 0])  # soma position
-    r1 = np.array([SL / 2, 0, 0])  # axon start position
-    rN = np.array([SL / 2 + AL - dk, 0, 0])  # axon stop position (start of the last segment)
-    rd = norm(r1 - r0) * np.array([
-        np.sin(phi) * np.cos(theta),
-        np.sin(phi) * np.sin(theta),
-        np.cos(phi)
-    ])  # dendrite end position, normalized
+    def unitFilters(dk: float) -> np.ndarray:
+        # soma position and axon compartments along the 3D points of the axon
+        r0, rk = section_util.axonPath(cell.allseclist, dk)
+        r1 = rk[0]  # axon start position
+        rd = r0 - (r1 - r0)  # dendrite end position, opposite to the axon start
+        return cachedMorphofiltdPath(elpos, rk, r0, rd)
+
     amp = stimParams.get('amp', 0.2)
-    Cs = amp * 10  # somatic equivalent dipole amplitude
-    taus = 23  # subsampling of the membrane current dk/taus = speed v)
+    # dk (axonal spatial sampling), taus (subsampling of the membrane
+    # current, dk/taus = speed v), somatic equivalent dipole amplitude and
+    # gain are fitted against LFPy on the first run of each morphology and
+    # HH template
+    calibrationKey = calibrations.key(section_util.morphologyKey(cell.allseclist),
+                                      method=hhMethod, stride=hhStride, dt=dt, dur=dur, delay=delay,
+                                      dks=DKS, tausRange=TAUS_RANGE)
+    calibration = calibrations.get(calibrationKey)
+    if calibration is None:
+        calibration = calibrate(unitFilters, Im, Vlfpy.T, inMVm - inmvm, amp, DKS, TAUS_RANGE)
+        calibrations.put(calibrationKey, calibration)
+    print('calibration:', calibration)
+    dk = calibration.dk
+    taus = calibration.taus
+    Cs = calibration.CsPerAmp * amp
 
     """
                      ----
-            -rd'----| r0 |r1-----------------------rN-
+            -rd'----| r0 |r1-----------------------rk[-1]-
                      ----
     """
 
@@ -155,31 +161,35 @@ def executeDemo(cell: LFPy.Cell,
     # simulation
     # -----------------------------------------------------------
 
-    w = morphofiltd(elpos, order, r0, r1, rN, rd, Cs)
-    wup = util.upsample(w.T, taus).T
-
-    Vel = np.zeros((len(w), len(Im)))
-
-    for iel in range(len(w)):
-        Vel[iel] = np.convolve(Im, wup[iel], 'same')
-
-    # cut
-    rangeStart = inMVm - inmvm - int(np.fix(wup.shape[1] / 2))
-    intervVm = np.arange(rangeStart, rangeStart + lVLFPy)
-    Vel2 = Vel[:, intervVm]
-
-    # normalize
-    stim_point = np.array([stim.x, stim.y, stim.z])
-    # index of the electrode that's closest to the stimulation point
-    elsync = util.findClosestPointIndex(elpos, stim_point)
-    Vel2 = Vel2 / norm(Vel2[elsync, :]) * norm(Vlfpy[:, elsync])
+    w = unitFilters(dk)
+    order = w.shape[1]
+    w[:, 0] *= Cs
+
+    # cut: only the samples of the LFPy window are computed
+    rangeStart = inMVm - inmvm - int(np.fix(order * taus / 2))
+    window = (rangeStart, rangeStart + lVLFPy)
+    decimation = 1 if outputRate is None else max(1, int(round(1 / (dt * outputRate))))
+    if outputRate is not None and not np.isclose(decimation * dt * outputRate, 1):
+        print(f'output rate rounded to {1 / (dt * decimation):g} kHz (decimation by {decimation})')
+    if rankTol is None:
+        Vel2 = convolution.convolvePolyphase(Im, w, taus, window=window, decimation=decimation)
+    else:
+        filters = convolution.lowRankFilters(w, rankTol)
+        print(f'filter rank = {filters.rank}, relative error = {filters.error:.2e}')
+        Vel2 = convolution.convolveLowRank(Im, filters, taus, window=window, decimation=decimation)
+
+    # scale
+    Vel2 = Vel2 * calibration.gain
 
     # -----------------------------------------------------------
     # plot grid
     # -----------------------------------------------------------
 
+    # LFPy potentials at the output rate
+    Vref = convolution.decimate(Vlfpy, decimation, axis=0)
+    dtOut = dt * decimation  # actual sampling period of the output
     cc = np.zeros((1, elpos.shape[0]))
-    t = util.closedRange(dt, dt * Vel2.shape[1], dt)
+    t = util.closedRange(dtOut, dtOut * Vel2.shape[1], dtOut)
 
     fig = plt.figure('Simulation comparison & Neuron Morphology')
     gs = fig.add_gridspec(nb_rows, nb_cols)
@@ -195,11 +205,11 @@ def executeDemo(cell: LFPy.Cell,
             ax = fig.add_subplot(gs[i, j])
             ax.axis('off')
             l1 = ax.plot(t, Vel2[ifil, :] - Vel2[ifil, 0], linewidth=2)
-            l2 = ax.plot(t, Vlfpy[:, ifil] - Vlfpy[0, ifil], linewidth=2)
+            l2 = ax.plot(t, Vref[:, ifil] - Vref[0, ifil], linewidth=2)
             if len(legend_handles) < 3:
                 legend_handles.append(l1[0])
                 legend_handles.append(l2[0])
-            res = np.corrcoef(Vel2[ifil].T, Vlfpy[:, ifil])[0][1]
+            res = np.corrcoef(Vel2[ifil].T, Vref[:, ifil])[0][1]
             cc[0, ifil] = max(0, res)
             rgba = cmap(cc[0, ifil])
             color = np.array([rgba])
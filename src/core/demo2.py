@@ -8,14 +8,13 @@ from typing import Dict
 import LFPy
 import matplotlib.pyplot as plt
 import numpy as np
-from numpy import pi
 from numpy.linalg import norm
 
 from src.app import section_util
-from src.core import util
-from src.core.hhrun import hhrun
+from src.core import convolution, hh_cache, util
+from src.core.hhrun import SpikeStop
 from src.core.lfpy_simulation import ElectrodeRanges, plotNeuron
-from src.core.morphofiltd import morphofiltd
+from src.core.filter_cache import cachedMorphofiltdPath
 
 
 def executeDemo(cell: LFPy.Cell,
@@ -59,26 +58,18 @@ def executeDemo(cell: LFPy.Cell,
     lVLFPy = 8000  # signal length in LFPy
     dt = 1 / 1000  # sampling period in ms
     Nt = 2 ** 15
-    D = Nt * dt
-    t = util.closedRange(dt, D, dt) - dt
-
-    # fe = 1 / dt
-    # f = np.arange(0, fe / 2, fe / Nt)
 
     dur = stimParams.get('dur', 10)
     delay = stimParams.get('delay', 1)
-    I = (
-            (np.heaviside(t - delay, 1 / 2) - np.heaviside(t - dur - delay, 1 / 2))
-            * 0.044 / (2 * pi * 12.5 * 25) * 10 ** 8 * 10 ** -3
-        # * 5.093 # 0.15 / (pi * 12.5 * 12.5 * 2 + 2 * pi * 12.5 * 25) * 10 ** 8
-    )
-    # icur = 1
-
-    # pot membrane, proportional to ion channels electric current
-    # (http://www.bem.fi/book/03/03.htm, 3.14)
-    Vm, m, n, h, INa, IK, Il = hhrun(I, t)
 
-    Im = (INa + IK + Il) * (2 * pi * 12.5 * 25) / 10 ** 8 * 10 ** 3
+    # integrated with the exponential Euler scheme at hhStride * dt, then
+    # resampled at dt for the morphological filter. The template of the
+    # stimulation is cached on disk, so repeated runs skip this stage, and
+    # truncated once the samples used after the spike peak are reached.
+    hhStride = 10
+    stop = SpikeStop(after=(lVLFPy - inmvm) * dt)
+    Vm, Im = hh_cache.membraneTemplate(dur, delay, dt, Nt, method='rush_larsen',
+                                       stride=hhStride, stop=stop)
     inMVm = np.argmax(Vm)
 
     # -----------------------------------------------------------
@@ -88,15 +79,10 @@ def executeDemo(cell: LFPy.Cell,
     dims = section_util.computeDimensions(cell.allseclist)
     print('dimensions:', dims)
 
-    SL = dims.get('SL', 25)  # soma length (cylinder with the same diameter)
-
-    AL = dims.get('AL', 1000)  # axon length
     AD = dims.get('AD', 2)  # axon diameter
 
     LD = dims.get('LD', 200)  # dendrite length
     DD = dims.get('DD', 2)  # dendrite diameter
-    phi = pi / 2  # angle with Oz
-    theta = pi  # angle with Ox (phi=pi/2,theta=pi) indicates opposite to the axon
 
     # -----------------------------------------------------------
     # filter parameters
@@ -104,22 +90,18 @@ def executeDemo(cell: LFPy.Cell,
 
     dk = 10  # axonal spatial sampling(~ nb of segments)
 
-    order = int(AL / dk + 1)
-    r0 = np.array([0, 0, 0])  # soma position
-    r1 = np.array([SL / 2, 0, 0])  # axon start position
-    rN = np.array([SL / 2 + AL - dk, 0, 0])  # axon stop position (start of the last segment)
-    rd = norm(r1 - r0) * np.array([
-        np.sin(phi) * np.cos(theta),
-        np.sin(phi) * np.sin(theta),
-        np.cos(phi)
-    ])  # dendrite end position, normalized
+    # soma position and axon compartments along the 3D points of the axon
+    r0, rk = section_util.axonPath(cell.allseclist, dk)
+    order = len(rk) + 1
+    r1 = rk[0]  # axon start position
+    rd = r0 - (r1 - r0)  # dendrite end position, opposite to the axon start
     amp = stimParams.get('amp', 0.2)
     Cs = amp * 10  # somatic equivalent dipole amplitude
     taus = 23  # subsampling of the membrane current dk/taus = speed v)
 
     """
                      ----
-            -rd'----| r0 |r1-----------------------rN-
+            -rd'----| r0 |r1-----------------------rk[-1]-
                      ----
     """
 
@@ -127,18 +109,11 @@ def executeDemo(cell: LFPy.Cell,
     # simulation
     # -----------------------------------------------------------
 
-    w = morphofiltd(elpos, order, r0, r1, rN, rd, Cs)
-    wup = util.upsample(w.T, taus).T
-
-    Vel = np.zeros((len(w), len(Im)))
-
-    for iel in range(len(w)):
-        Vel[iel] = np.convolve(Im, wup[iel], 'same')
+    w = cachedMorphofiltdPath(elpos, rk, r0, rd, Cs)
 
-    # cut
-    rangeStart = inMVm - inmvm - int(np.fix(wup.shape[1] / 2))
-    intervVm = np.arange(rangeStart, rangeStart + lVLFPy)
-    Vel2 = Vel[:, intervVm]
+    # cut: only the samples of the LFPy window are computed
+    rangeStart = inMVm - inmvm - int(np.fix(order * taus / 2))
+    Vel2 = convolution.convolvePolyphase(Im, w, taus, window=(rangeStart, rangeStart + lVLFPy))
     # normalize
     elsync = elpos.shape[0] - 10  # value was 55
     Vel2 = Vel2 / norm(Vel2[elsync, :]) * norm(result[:, elsync])
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module caches the weights of the morphological filter (see
+``morphofiltd``), which only depend on the geometry of the electrodes and of
+the cell. Simulations that only change the stimulation (amplitude, timing)
+reuse the weights instead of recomputing them, and a changed electrode grid
+only computes the rows of its new positions.
+
+Two layers are used: a bounded in-process LRU and an optional on-disk
+layer of ``.npz`` files. Entries are stored for a unit somatic dipole
+(``Cs = 1``); since ``Cs`` only scales the first column of the weights, it
+is applied at lookup and is not part of the key, so amplitude sweeps share
+one entry.
+
+@author: Loïc Bertrand, Tony Zhou
+"""
+import hashlib
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from src.core import morphofiltd as morphofiltd_module
+from src.core.morphofiltd import morphofiltd, morphofiltdPath
+
+DEFAULT_MAX_ENTRIES = 32
+DEFAULT_MAX_ROWS = 10 ** 6
+
+
+class FilterEntry:
+    """
+    Weights of the filter of a geometry for a set of electrode positions
+    """
+
+    def __init__(self, positions: np.ndarray, weights: np.ndarray):
+        self.positions = np.ascontiguousarray(positions, dtype=np.float64)
+        self.weights = weights
+        self.positions.flags.writeable = False
+        self.weights.flags.writeable = False
+        self._index = {pos.tobytes(): i for i, pos in enumerate(self.positions)}
+
+    def __len__(self):
+        return len(self.positions)
+
+    def find(self, re: np.ndarray) -> np.ndarray:
+        """
+        :param re:  electrode positions (M x 3)
+        :return:    row of each position in the entry, -1 if missing
+        """
+        re = np.ascontiguousarray(re, dtype=np.float64)
+        return np.array([self._index.get(pos.tobytes(), -1) for pos in re], dtype=int)
+
+
+class FilterCache:
+    """
+    LRU cache of filter weights, kept in memory and optionally on disk.
+    Entries are indexed by geometry and hold one row per electrode
+    position, so a new electrode grid only needs the rows of its new
+    positions.
+    """
+
+    def __init__(self, maxEntries: int = DEFAULT_MAX_ENTRIES, directory: Optional[Path] = None,
+                 maxRows: int = DEFAULT_MAX_ROWS):
+        """
+        :param maxEntries:  maximum number of entries kept in memory
+        :param directory:   directory of the on-disk layer, created if needed
+            (default: no on-disk layer)
+        :param maxRows:     maximum number of electrode positions per entry,
+            older positions being dropped beyond
+        """
+        self.maxEntries = maxEntries
+        self.directory = None if directory is None else Path(directory)
+        self.maxRows = maxRows
+        self._entries = OrderedDict()
+
+    @staticmethod
+    def key(*arrays, **params) -> str:
+        """
+        :param arrays:  arrays identifying an entry (compared by value, as
+            float64)
+        :param params:  other parameters identifying an entry
+        :return:        content address of the entry
+        """
+        digest = hashlib.sha256()
+        for arr in arrays:
+            arr = np.ascontiguousarray(arr, dtype=np.float64)
+            digest.update(str(arr.shape).encode())
+            digest.update(arr.tobytes())
+        digest.update(repr(sorted(params.items())).encode())
+        return digest.hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f'{key}.npz'
+
+    def get(self, key: str) -> Optional[FilterEntry]:
+        """
+        :param key:     entry key
+        :return:        the cached entry or ``None``
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+        if self.directory is None:
+            return None
+        try:
+            with np.load(self._path(key)) as data:
+                entry = FilterEntry(data['re'], data['w'])
+        except (OSError, ValueError, KeyError):
+            return None
+        self._remember(key, entry)
+        return entry
+
+    def put(self, key: str, entry: FilterEntry):
+        """
+        Stores an entry in memory and, if enabled, on disk.
+        """
+        self._remember(key, entry)
+        if self.directory is not None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            path = self._path(key)
+            tmp = path.with_suffix('.tmp')
+            with open(tmp, 'wb') as f:
+                np.savez(f, re=entry.positions, w=entry.weights)
+            os.replace(tmp, path)
+
+    def lookup(self, key: str, re: np.ndarray, compute) -> np.ndarray:
+        """
+        Returns the weights of the electrodes ``re``, computing only the rows
+        of the positions missing from the entry, which is then extended.
+
+        :param key:     entry key
+        :param re:      electrode positions (M x 3)
+        :param compute: function returning the weights of given positions
+        :return:        weights (M x order)
+        """
+        re = np.array(re, dtype=np.float64, ndmin=2)
+        entry = self.get(key)
+        if entry is None:
+            new, inverse = np.unique(re, axis=0, return_inverse=True)
+            entry = FilterEntry(new, compute(new))
+            self.put(key, entry)
+            return entry.weights[inverse.ravel()]
+        rows = entry.find(re)
+        missing = rows < 0
+        if missing.any():
+            new, inverse = np.unique(re[missing], axis=0, return_inverse=True)
+            rows[missing] = len(entry) + inverse.ravel()
+            positions = np.concatenate([entry.positions, new])
+            weights = np.concatenate([entry.weights, compute(new)])
+            if len(positions) > self.maxRows:
+                # only the requested positions are kept
+                kept, rows = np.unique(rows, return_inverse=True)
+                positions, weights = positions[kept], weights[kept]
+            entry = FilterEntry(positions, weights)
+            self.put(key, entry)
+        return entry.weights[rows]
+
+    def clear(self):
+        self._entries.clear()
+        if self.directory is not None:
+            for path in self.directory.glob('*.npz'):
+                path.unlink()
+
+    def _remember(self, key: str, entry: FilterEntry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxEntries:
+            self._entries.popitem(last=False)
+
+
+DEFAULT_CACHE = FilterCache()  # in memory only, pass a directory for the on-disk layer
+
+
+def _sourceHash() -> str:
+    with open(morphofiltd_module.__file__, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _cached(cache: FilterCache, key: str, re: np.ndarray, compute, Cs) -> np.ndarray:
+    result = cache.lookup(key, re, compute)
+    result[:, 0] *= Cs
+    return result
+
+
+def cachedMorphofiltd(re: np.ndarray, order: int, r0: np.ndarray, r1: np.ndarray,
+                      rN: np.ndarray, rD: np.ndarray = None, Cs=1,
+                      cache: Optional[FilterCache] = DEFAULT_CACHE) -> np.ndarray:
+    """
+    Same as ``morphofiltd``, the weights for ``Cs = 1`` being read from and
+    stored in ``cache`` (no caching if ``None``); only the electrode
+    positions missing from the cache are computed. The first column is then
+    scaled by ``Cs``, which matches ``morphofiltd`` up to rounding.
+    """
+    if cache is None:
+        return morphofiltd(re, order, r0, r1, rN, rD, Cs)
+    if rD is None:
+        rD = r1
+    key = cache.key(r0, r1, rN, rD, order=order, source=_sourceHash())
+    return _cached(cache, key, re, lambda new: morphofiltd(new, order, r0, r1, rN, rD), Cs)
+
+
+def cachedMorphofiltdPath(re: np.ndarray, rk: np.ndarray, r0: np.ndarray,
+                          rD: np.ndarray = None, Cs=1,
+                          cache: Optional[FilterCache] = DEFAULT_CACHE) -> np.ndarray:
+    """
+    Same as ``morphofiltdPath``, with the caching of ``cachedMorphofiltd``.
+    """
+    if cache is None:
+        return morphofiltdPath(re, rk, r0, rD, Cs)
+    if rD is None:
+        rD = rk[0]
+    key = cache.key(rk, r0, rD, path=True, source=_sourceHash())
+    return _cached(cache, key, re, lambda new: morphofiltdPath(new, rk, r0, rD), Cs)
@@ -0,0 +1,73 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from numpy.testing import assert_allclose, assert_array_equal
+
+from src.core import filter_cache
+from src.core.filter_cache import FilterCache, FilterEntry, cachedMorphofiltd
+from src.core.morphofiltd import morphofiltd
+
+
+class FilterCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.re = np.random.default_rng(0).uniform(-500, 500, (20, 3))
+        self.geometry = (np.array([0, 0, 0]), np.array([12.5, 0, 0]), np.array([1002.5, 0, 0]))
+
+    def test_key_depends_on_geometry(self):
+        key = FilterCache.key(*self.geometry, order=11)
+        self.assertEqual(key, FilterCache.key(*(r.copy() for r in self.geometry), order=11))
+        self.assertNotEqual(key, FilterCache.key(*(r + 1 for r in self.geometry), order=11))
+        self.assertNotEqual(key, FilterCache.key(*self.geometry, order=12))
+
+    def test_lru_eviction(self):
+        cache = FilterCache(maxEntries=2)
+        for key in 'abc':
+            cache.put(key, FilterEntry(np.zeros((1, 3)), np.zeros((1, 2))))
+            cache.get('a')
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+
+    def test_incremental_rows(self):
+        cache = FilterCache()
+        cachedMorphofiltd(self.re[:15], 11, *self.geometry, cache=cache)
+        computed = []
+
+        def spy(re, *args, **kwargs):
+            computed.append(len(re))
+            return morphofiltd(re, *args, **kwargs)
+
+        re = np.concatenate([self.re[5:], self.re[5:7]])
+        with mock.patch.object(filter_cache, 'morphofiltd', side_effect=spy):
+            w = cachedMorphofiltd(re, 11, *self.geometry, Cs=3, cache=cache)
+        self.assertEqual(computed, [5])
+        assert_allclose(w, morphofiltd(re, 11, *self.geometry, Cs=3), rtol=1e-15)
+        cache.maxRows = 10
+        w = cachedMorphofiltd(self.re[:3] + 1, 11, *self.geometry, cache=cache)
+        assert_allclose(w, morphofiltd(self.re[:3] + 1, 11, *self.geometry), rtol=1e-15)
+        self.assertEqual([len(entry) for entry in cache._entries.values()], [3])
+
+    def test_amplitude_sweep_reuses_entry(self):
+        cache = FilterCache()
+        expected = morphofiltd(self.re, 11, *self.geometry, Cs=2)
+        assert_allclose(cachedMorphofiltd(self.re, 11, *self.geometry, Cs=2, cache=cache),
+                        expected, rtol=1e-15)
+        with mock.patch.object(filter_cache, 'morphofiltd') as compute:
+            w = cachedMorphofiltd(self.re, 11, *self.geometry, Cs=5, cache=cache)
+            compute.assert_not_called()
+        assert_allclose(w, morphofiltd(self.re, 11, *self.geometry, Cs=5), rtol=1e-15)
+
+    def test_disk_layer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            w = cachedMorphofiltd(self.re, 11, *self.geometry, cache=FilterCache(directory=directory))
+            with mock.patch.object(filter_cache, 'morphofiltd') as compute:
+                w2 = cachedMorphofiltd(self.re, 11, *self.geometry,
+                                       cache=FilterCache(directory=directory))
+                compute.assert_not_called()
+            assert_array_equal(w, w2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module computes the membrane voltage and current templates (``Vm``,
+``Im``) of the fast simulation with ``hhrun`` and stores them in a
+persistent on-disk cache, so that repeated simulations with the same
+stimulation skip the Hodgkin–Huxley stage.
+
+Entries are content-addressed: the key is a hash of the stimulation
+parameters, of the time discretisation, of the integration options, of the
+HH constants and of the HH sources. The stop condition of the integration
+is not part of it: entries hold the whole template, truncated after lookup.
+The cache directory is bounded in size, the least recently used entries
+being evicted first.
+
+@author: Loïc Bertrand, Tony Zhou
+"""
+import dataclasses
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional, Tuple
+
+import numpy as np
+from numpy import pi
+
+from src.core import hhrun as hhrun_module
+from src.core import hh_rates, util
+from src.core.hhrun import HHParams, SpikeStop, hhrun, stopLength
+
+STIM_AMPLITUDE = 0.044  # nA, amplitude of the stimulation of the HH soma
+SOMA_AREA = 2 * pi * 12.5 * 25  # μm², lateral area of the HH soma
+
+DEFAULT_DIRECTORY = util.cacheDirectory('hh')
+DEFAULT_MAX_BYTES = 256 * 2 ** 20
+
+
+class TemplateCache:
+    """
+    Size-bounded LRU cache of ``(Vm, Im)`` pairs stored as ``.npy`` files
+    """
+
+    def __init__(self, directory: Path = DEFAULT_DIRECTORY, maxBytes: int = DEFAULT_MAX_BYTES):
+        """
+        :param directory:   cache directory, created if needed
+        :param maxBytes:    maximum total size of the cached files
+        """
+        self.directory = Path(directory)
+        self.maxBytes = maxBytes
+
+    @staticmethod
+    def key(**params) -> str:
+        """
+        :param params:  JSON-serializable parameters identifying an entry
+        :return:        content address of the entry
+        """
+        return util.contentKey(**params)
+
+    def _paths(self, key: str) -> Tuple[Path, Path]:
+        return self.directory / f'{key}_Vm.npy', self.directory / f'{key}_Im.npy'
+
+    def get(self, key: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        :param key:     entry key
+        :return:        ``(Vm, Im)`` or ``None`` if the entry is missing
+        """
+        pathVm, pathIm = self._paths(key)
+        try:
+            Vm = np.load(pathVm)
+            Im = np.load(pathIm)
+        except (OSError, ValueError):
+            return None
+        os.utime(pathVm)  # marks the entry as recently used
+        return Vm, Im
+
+    def put(self, key: str, Vm: np.ndarray, Im: np.ndarray):
+        """
+        Stores an entry, then evicts the least recently used entries until
+        the cache fits in ``maxBytes``.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        for path, arr in zip(self._paths(key), (Vm, Im)):
+            tmp = path.with_suffix('.tmp')
+            with open(tmp, 'wb') as f:
+                np.save(f, arr)
+            os.replace(tmp, path)
+        self._evict()
+
+    def clear(self):
+        for path in self.directory.glob('*_?m.npy'):
+            path.unlink()
+
+    def _evict(self):
+        entries = []
+        for pathVm in self.directory.glob('*_Vm.npy'):
+            pathIm = pathVm.with_name(pathVm.name.replace('_Vm', '_Im'))
+            try:
+                size = pathVm.stat().st_size + pathIm.stat().st_size
+                entries.append((pathVm.stat().st_mtime, size, pathVm, pathIm))
+            except OSError:
+                continue
+        total = sum(e[1] for e in entries)
+        for _, size, pathVm, pathIm in sorted(entries, key=lambda e: e[0]):
+            if total <= self.maxBytes:
+                break
+            for path in (pathVm, pathIm):
+                try:
+                    path.unlink()
+                except OSError:
+                    pass
+            total -= size
+
+
+DEFAULT_CACHE = TemplateCache()
+
+
+def _hhSourceHash() -> str:
+    digest = hashlib.sha256()
+    for module in (hhrun_module, hh_rates):
+        with open(module.__file__, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def _timeVector(dt: float, Nt: int) -> np.ndarray:
+    return util.closedRange(dt, Nt * dt, dt) - dt
+
+
+def computeTemplate(dur: float, delay: float, dt: float, Nt: int,
+                    method: str = 'euler', stride: int = 1,
+                    stop: Optional[SpikeStop] = None,
+                    params: Optional[HHParams] = None,
+                    fromRest: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Runs the HH model of the soma for a current pulse.
+
+    :param dur:     duration of the stimulation (ms)
+    :param delay:   delay of the stimulation (ms)
+    :param dt:      sampling period (ms)
+    :param Nt:      number of samples
+    :param method:  integration method of ``hhrun``
+    :param stride:  integration stride of ``hhrun``
+    :param stop:    stop condition of ``hhrun``
+    :param params:  constants of the HH model (default: ``HHParams()``)
+    :param fromRest:    starts ``hhrun`` from the resting state of the model
+    :return:        membrane voltage (mV) and membrane current (nA)
+    """
+    t = _timeVector(dt, Nt)
+    I = (
+            (np.heaviside(t - delay, 1 / 2) - np.heaviside(t - dur - delay, 1 / 2))
+            * STIM_AMPLITUDE / SOMA_AREA * 10 ** 8 * 10 ** -3
+    )
+    # pot membrane, proportional to ion channels electric current
+    # (http://www.bem.fi/book/03/03.htm, 3.14)
+    Vm, Im = hhrun(I, t, method=method, stride=stride, stop=stop, params=params,
+                   outputs=('V', 'Im'), fromRest=fromRest)
+    Im = Im * SOMA_AREA / 10 ** 8 * 10 ** 3
+    return Vm, Im
+
+
+def membraneTemplate(dur: float, delay: float, dt: float, Nt: int,
+                     method: str = 'euler', stride: int = 1,
+                     stop: Optional[SpikeStop] = None,
+                     params: Optional[HHParams] = None,
+                     fromRest: bool = False,
+                     cache: Optional[TemplateCache] = DEFAULT_CACHE) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Same as ``computeTemplate``, the result being read from and stored in
+    ``cache`` (no caching if ``None``). The cache holds the template of the
+    stimulation without stop condition, which is applied after lookup, so
+    the entry is shared by all the stop conditions.
+    """
+    params = HHParams() if params is None else params
+    if cache is None:
+        return computeTemplate(dur, delay, dt, Nt, method, stride, stop, params, fromRest)
+    key = cache.key(
+        dur=dur, delay=delay, amplitude=STIM_AMPLITUDE, area=SOMA_AREA,
+        dt=dt, Nt=Nt, method=method, stride=stride,
+        params=dataclasses.asdict(params), fromRest=fromRest,
+        hhrun=_hhSourceHash(),
+    )
+    result = cache.get(key)
+    if result is None:
+        result = computeTemplate(dur, delay, dt, Nt, method, stride, None, params, fromRest)
+        cache.put(key, *result)
+    if stop is not None:
+        Vm, Im = result
+        end = stopLength(Vm, _timeVector(dt, Nt), stop, stride)
+        result = Vm[:end], Im[:end]
+    return result
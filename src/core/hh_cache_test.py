@@ -0,0 +1,79 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+from numpy.testing import assert_array_equal
+
+from src.core import hh_cache
+from src.core.hh_cache import TemplateCache
+from src.core.hhrun import SpikeStop
+
+
+class HhCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache = TemplateCache(self.tmp.name)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_key_depends_on_params(self):
+        self.assertEqual(TemplateCache.key(dur=1, delay=2), TemplateCache.key(delay=2, dur=1))
+        self.assertNotEqual(TemplateCache.key(dur=1, delay=2), TemplateCache.key(dur=1, delay=3))
+
+    def test_put_get(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.put('a', np.arange(3.), np.ones(3))
+        Vm, Im = self.cache.get('a')
+        assert_array_equal(Vm, np.arange(3.))
+        assert_array_equal(Im, np.ones(3))
+
+    def _setAccessTime(self, key, seconds):
+        # explicit access times, the order of the eviction not depending on
+        # the resolution of the file system clock
+        for path in self.cache.directory.glob(f'{key}_?m.npy'):
+            os.utime(path, (seconds, seconds))
+
+    def test_lru_eviction(self):
+        arr = np.zeros(1000)
+        self.cache.put('a', arr, arr)
+        self._setAccessTime('a', 1000)
+        entrySize = sum(p.stat().st_size for p in self.cache.directory.iterdir())
+        self.cache.maxBytes = 2 * entrySize
+        self.cache.put('b', arr, arr)
+        self._setAccessTime('b', 2000)
+        self.assertIsNotNone(self.cache.get('a'))  # 'b' becomes the least recently used entry
+        self.assertGreater(self.cache.directory.joinpath('a_Vm.npy').stat().st_mtime, 2000)
+        self.cache.put('c', arr, arr)
+        self.assertIsNotNone(self.cache.get('a'))
+        self.assertIsNone(self.cache.get('b'))
+        self.assertIsNotNone(self.cache.get('c'))
+
+    def test_membrane_template_skips_hh_on_hit(self):
+        args = (10, 1, 1 / 1000, 2000)
+        Vm, Im = hh_cache.membraneTemplate(*args, cache=self.cache)
+        with mock.patch.object(hh_cache, 'computeTemplate') as compute:
+            Vm2, Im2 = hh_cache.membraneTemplate(*args, cache=self.cache)
+            compute.assert_not_called()
+        assert_array_equal(Vm, Vm2)
+        assert_array_equal(Im, Im2)
+
+    def test_membrane_template_truncated_after_lookup(self):
+        args = (10, 1, 1 / 1000, 30000, 'rush_larsen', 10)
+        for after in (2, 3):
+            stop = SpikeStop(after=after, chunk=100)
+            expected = hh_cache.computeTemplate(*args, stop=stop)
+            self.assertLess(len(expected[0]), 30000)
+            # the entry of the stimulation is shared by the stop conditions
+            with mock.patch.object(hh_cache, 'computeTemplate', wraps=hh_cache.computeTemplate) as compute:
+                Vm, Im = hh_cache.membraneTemplate(*args, stop=stop, cache=self.cache)
+                self.assertEqual(compute.call_count, 1 if after == 2 else 0)
+            assert_array_equal(Vm, expected[0])
+            assert_array_equal(Im, expected[1])
+
+
+if __name__ == '__main__':
+    unittest.main()
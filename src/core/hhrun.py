@@ -4,13 +4,356 @@
 @author: Loïc Bertrand, Steven Le Cam, Radu Ranta, Tony Zhou
 """
 
-from typing import Tuple
+from dataclasses import astuple, dataclass, fields, replace
+from functools import lru_cache
+from typing import Dict, Optional, Sequence, Tuple
 
-from numpy import exp, zeros
+from numpy import (abs, asarray, atleast_2d, broadcast_arrays, broadcast_to, concatenate, exp,
+                   flatnonzero, float64, full, linspace, logical_and, meshgrid, where, zeros)
 from numpy.core.multiarray import ndarray
 
+from src.core import hh_rates, util
+from src.core.hh_rates import RateTable
 
-def hhrun(I: ndarray, t: ndarray) -> Tuple[ndarray, ...]:
+METHODS = ('euler', 'rush_larsen')
+OUTPUTS = ('V', 'm', 'n', 'h', 'INa', 'IK', 'Il')
+# traces which can be requested, Im being the total membrane current
+TRACES = OUTPUTS + ('Im',)
+
+
+@dataclass
+class HHParams:
+    """
+    Constants of the Hodgkin–Huxley model used by ``hhrun``, from Gerstner
+    EPFL page (http://icwww.epfl.ch/~gerstner/SPNM/node14.html).
+
+    With ``hhrun_batch``, each field can also be an array holding one value
+    per condition (see ``hhrun_sweep``).
+    """
+    Cm: float = 1  # uF/cm**2 Membrane capacitance
+    ENa: float = 115-65  # mv Na reversal potential
+    EK: float = -12-65  # mv K reversal potential
+    El: float = 10.7-65  # mv Leakage reversal potential
+    gbarNa: float = 120  # mS/cm**2 Na conductance
+    gbarK: float = 36  # mS/cm**2 K conductance
+    gbarl: float = 0.3  # mS/cm**2 Leakage conductance
+
+
+@dataclass
+class SpikeStop:
+    """
+    Stop condition for ``hhrun``: the integration ends ``after`` ms after
+    the first spike peak, as soon as the membrane voltage is back within
+    ``tolerance`` mV of its initial value. The output arrays are allocated
+    by blocks of ``chunk`` samples, so only the integrated window is ever
+    allocated, and they are truncated to that window on return.
+    """
+    after: float = 5  # ms after the first spike peak
+    tolerance: float = 10  # mV around the initial membrane voltage
+    threshold: float = 0  # mV, a spike is detected when V crosses it
+    chunk: int = 4096  # samples allocated at once
+
+
+class _SpikeTracker:
+    """
+    Evaluates a ``SpikeStop`` condition on a single voltage trace
+    """
+
+    def __init__(self, stop: SpikeStop, v0: float, dt: float):
+        self.stop = stop
+        self.v0 = v0
+        self.dt = dt
+        self.peak = None  # index of the first spike peak
+        self.peakV = stop.threshold
+        self.inSpike = False
+
+    def update(self, i: int, v: float) -> bool:
+        """
+        :return:    ``True`` if the integration can stop at sample ``i``
+        """
+        if self.peak is None or self.inSpike:
+            if v > self.peakV:
+                self.peakV = v
+                self.peak = i
+                self.inSpike = True
+            elif v < self.stop.threshold:
+                self.inSpike = False
+            return False
+        return ((i - self.peak) * self.dt >= self.stop.after
+                and abs(v - self.v0) < self.stop.tolerance)
+
+
+class _BatchSpikeTracker:
+    """
+    Evaluates a ``SpikeStop`` condition on every row of a batch, the
+    integration can stop once all the rows satisfy it
+    """
+
+    def __init__(self, stop: SpikeStop, v0, dt: float):
+        self.stop = stop
+        self.v0 = v0
+        self.dt = dt
+        self.peak = full(v0.shape, -1)
+        self.peakV = full(v0.shape, float(stop.threshold))
+        self.inSpike = zeros(v0.shape, dtype=bool)
+        self.done = zeros(v0.shape, dtype=bool)
+
+    def update(self, i: int, v) -> bool:
+        tracking = (self.peak < 0) | self.inSpike
+        higher = tracking & (v > self.peakV)
+        self.peakV = where(higher, v, self.peakV)
+        self.peak = where(higher, i, self.peak)
+        self.inSpike = higher | (self.inSpike & (v >= self.stop.threshold))
+        self.done |= logical_and.reduce([
+            self.peak >= 0, ~self.inSpike,
+            (i - self.peak) * self.dt >= self.stop.after,
+            abs(v - self.v0) < self.stop.tolerance,
+        ])
+        return bool(self.done.all())
+
+
+def stopLength(V: ndarray, t: ndarray, stop: SpikeStop, stride: int = 1) -> int:
+    """
+    Length of the output of ``hhrun`` stopped by ``stop``, from the membrane
+    voltage of the same run without stop condition (the stopped outputs
+    being the beginning of the full ones), e.g. to truncate a stored trace.
+
+    :param V:       membrane voltage of the run without stop condition (mV)
+    :param t:       time vector of the run (ms)
+    :param stop:    stop condition
+    :param stride:  integration stride of the run
+    :return:        number of samples of the stopped run
+    """
+    coarse = V[::stride]
+    tc = t[::stride]
+    tracker = _SpikeTracker(stop, coarse[0], tc[1] - tc[0])
+    for i in range(1, len(coarse)):
+        if tracker.update(i, coarse[i]):
+            return min(len(V), i * stride + 1)
+    return len(V)
+
+
+def _record(arrays, i: int, v, m, n, h, INa, IK, Il):
+    """
+    Writes the state at sample ``i`` in the requested output arrays
+    (``None`` for the traces which are not stored), in the order of TRACES
+    """
+    for arr, value in zip(arrays, (v, m, n, h, INa, IK, Il, INa + IK + Il)):
+        if arr is not None:
+            arr[i] = value
+
+
+def _grow(arrays, size: int):
+    """
+    Extends the arrays (along the first axis) with zeros up to ``size``
+    """
+    return tuple(concatenate([x, zeros((size - len(x),) + x.shape[1:], x.dtype)]) for x in arrays)
+
+
+def _steadyGates(v):
+    """
+    :return:    steady-state values of the gates (m, n, h) at voltage ``v``
+    """
+    a_m, b_m, a_n, b_n, a_h, b_h = hh_rates.rates(asarray(v, dtype=float))
+    return a_m / (a_m + b_m), a_n / (a_n + b_n), a_h / (a_h + b_h)
+
+
+@lru_cache(maxsize=1024)
+def _restingState(params: Tuple[float, ...], I: float) -> Tuple[float, float, float, float]:
+    p = HHParams(*params)
+
+    def current(v):
+        m, n, h = _steadyGates(v)
+        return (p.gbarNa * m ** 3 * h * (v - p.ENa) + p.gbarK * n ** 4 * (v - p.EK)
+                + p.gbarl * (v - p.El) - I)
+
+    # lowest stable crossing (increasing current) on a coarse grid, refined
+    # by bisection
+    v = linspace(-150, 100, 501)
+    f = current(v)
+    crossings = flatnonzero((f[:-1] < 0) & (f[1:] >= 0))
+    if len(crossings) == 0:
+        raise ValueError(f'no resting state found for {p} and I = {I}')
+    lo, hi = v[crossings[0]], v[crossings[0] + 1]
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if current(mid) < 0:
+            lo = mid
+        else:
+            hi = mid
+    rest = float(lo + hi) / 2
+    return (rest,) + tuple(float(x) for x in _steadyGates(rest))
+
+
+def restingState(params: Optional[HHParams] = None, I: float = 0) -> Tuple[float, float, float, float]:
+    """
+    Computes the steady state of the HH model under a constant stimulation
+    ``I`` (the resting state for ``I = 0``): the voltage where the total
+    ionic current, with every gate at its steady-state value, balances
+    ``I``. Results are memoized per parameter set.
+
+    :param params:  constants of the model (default: ``HHParams()``),
+        scalar fields only
+    :param I:       constant stimulation intensity
+    :return:        (V, m, n, h) at the steady state
+    """
+    p = HHParams() if params is None else params
+    return _restingState(astuple(p), float(I))
+
+
+def _batchRestingState(params: HHParams, count: int):
+    """
+    Steady states of a batch whose parameters may hold one value per
+    condition
+    """
+    values = broadcast_arrays(*[asarray(x, dtype=float) for x in astuple(params)],
+                              zeros(count))[:-1]
+    states = [restingState(HHParams(*(float(x[i]) for x in values))) for i in range(count)]
+    return tuple(asarray(x) for x in zip(*states))
+
+
+def _checkMethod(method: str):
+    if method not in METHODS:
+        raise ValueError(f'unknown integration method: {method} (expected one of {METHODS})')
+
+
+def _checkOutputs(outputs: Sequence[str]):
+    unknown = [name for name in outputs if name not in TRACES]
+    if unknown:
+        raise ValueError(f'unknown outputs: {unknown} (expected some of {TRACES})')
+
+
+def _coarsen(I: ndarray, t: ndarray, stride: int) -> Tuple[ndarray, ndarray]:
+    """
+    Keeps every ``stride``-th time sample, the stimulation being averaged
+    over each coarse step so that the injected charge is preserved.
+    """
+    tc = t[::stride]
+    pad = (-I.shape[-1]) % stride
+    if pad:
+        I = concatenate([I, I[..., -1:].repeat(pad, axis=-1)], axis=-1)
+    Ic = I.reshape(I.shape[:-1] + (-1, stride)).mean(axis=-1)
+    return Ic, tc
+
+
+def _expGate(x, a, b, dt):
+    """
+    Exponential (exact for a fixed voltage) update of a gating variable
+    """
+    s = a + b
+    return a / s + (x - a / s) * exp(-dt * s)
+
+
+def _rushLarsenStep(v, m, n, h, I, dt, rates, Cm, ENa, EK, El, gbarNa, gbarK, gbarl):
+    """
+    Performs one step of the exponential Euler (Rush–Larsen) scheme: the
+    gates are updated exponentially and the voltage with a semi-implicit
+    (backward Euler) step using the conductances of the updated gates.
+    The rates are first evaluated at ``v`` to predict the next voltage,
+    then at the midpoint voltage for the actual update, which makes the
+    scheme accurate for time steps 10 to 25 times larger than forward
+    Euler. Works on scalars as well as on arrays.
+
+    :return (m, n, h, V) at the next step
+    """
+
+    def advance(a_m, b_m, a_n, b_n, a_h, b_h):
+        m1 = _expGate(m, a_m, b_m, dt)
+        n1 = _expGate(n, a_n, b_n, dt)
+        h1 = _expGate(h, a_h, b_h, dt)
+        gNa = gbarNa * m1 ** 3 * h1
+        gK = gbarK * n1 ** 4
+        v1 = ((v + dt / Cm * (I + gNa * ENa + gK * EK + gbarl * El))
+              / (1 + dt / Cm * (gNa + gK + gbarl)))
+        return m1, n1, h1, v1
+
+    # predictor
+    *_, vp = advance(*rates(v))
+    # corrector
+    return advance(*rates((v + vp) / 2))
+
+
+def _resampleOutputs(result, tc: ndarray, t: ndarray, stride: int):
+    """
+    Interpolates outputs computed on ``tc = t[::stride]`` (possibly stopped
+    early) back onto ``t``
+    """
+    length = result[0].shape[-1]
+    end = len(t) if length == len(tc) else (length - 1) * stride + 1
+    tc = tc[:length]
+    return tuple(util.resample(x, tc, t[:end]).astype(x.dtype, copy=False) for x in result)
+
+
+def _integrate(I: ndarray, length: int, dt: float, v, mi, ni, hi, rates, method: str,
+               p: HHParams, stop: Optional[SpikeStop], tracker, outputs: Sequence[str], dtype,
+               shape: Tuple[int, ...] = ()) -> Tuple[ndarray, ...]:
+    """
+    Time loop shared by ``hhrun``, whose state (v, mi, ni, hi) is made of
+    Python scalars, and ``hhrun_batch``, whose state holds one value per
+    condition (``shape``), ``I`` having time along its first axis.
+
+    :return:    the traces listed in ``outputs``, time along the first axis
+    """
+    # Array initializations (requested outputs only): time along the first
+    # axis so that each step writes a contiguous row
+    size = length if stop is None else min(length, stop.chunk)
+    out = {name: zeros((size,) + shape, dtype) for name in outputs}
+    arrays = [out.get(name) for name in TRACES]
+
+    Cm, ENa, EK, El = p.Cm, p.ENa, p.EK, p.El
+    gbarNa, gbarK, gbarl = p.gbarNa, p.gbarK, p.gbarl
+    rushLarsen = method == 'rush_larsen'
+    gNa = gbarNa * mi ** 3 * hi
+    gK = gbarK * ni ** 4
+    gl = gbarl
+    i = -1
+    for i in range(length - 1):
+        if i + 1 == size:
+            size = min(length, size + stop.chunk)
+            out = dict(zip(out, _grow(out.values(), size)))
+            arrays = [out.get(name) for name in TRACES]
+        if rushLarsen:
+            m1, n1, h1, v1 = _rushLarsenStep(
+                v, mi, ni, hi, I[i], dt, rates,
+                Cm, ENa, EK, El, gbarNa, gbarK, gbarl)
+        else:
+            a_m, b_m, a_n, b_n, a_h, b_h = rates(v)
+            # Euler method to find the next m/n/h value
+            m1 = mi + dt * ((a_m * (1 - mi)) - (b_m * mi))
+            n1 = ni + dt * ((a_n * (1 - ni)) - (b_n * ni))
+            h1 = hi + dt * ((a_h * (1 - hi)) - (b_h * hi))
+        gNa = gbarNa * mi ** 3 * hi
+        gK = gbarK * ni ** 4
+        iNa = gNa * (v - ENa)
+        iK = gK * (v - EK)
+        il = gl * (v - El)
+        if not rushLarsen:
+            # Euler method to find the next voltage value
+            v1 = v + dt * ((1 / Cm) * (I[i] - (iNa + iK + il)))
+        _record(arrays, i, v, mi, ni, hi, iNa, iK, il)
+        v, mi, ni, hi = v1, m1, n1, h1
+        if tracker is not None and tracker.update(i + 1, v):
+            # the last currents are computed from the updated gates, which
+            # is how a longer run computes them at this sample (the last
+            # sample of a run which is not stopped uses the previous gates)
+            gNa = gbarNa * mi ** 3 * hi
+            gK = gbarK * ni ** 4
+            break
+    _record(arrays, i + 1, v, mi, ni, hi, gNa * (v - ENa), gK * (v - EK), gl * (v - El))
+
+    end = i + 2
+    return tuple(out[name][:end] for name in outputs)
+
+
+def hhrun(I: ndarray, t: ndarray,
+          rateTable: Optional[RateTable] = None,
+          method: str = 'euler',
+          stride: int = 1,
+          stop: Optional[SpikeStop] = None,
+          params: Optional[HHParams] = None,
+          outputs: Sequence[str] = OUTPUTS,
+          dtype=float64,
+          fromRest: bool = False) -> Tuple[ndarray, ...]:
     """
     Performs Hodgkin–Huxley algorithm
 
@@ -23,10 +366,37 @@ def hhrun(I: ndarray, t: ndarray) -> Tuple[ndarray, ...]:
         - IK:   potassium ionic currents
         - Il:   leakage currents
 
-    :param I:   stimulation intensity vector
-    :param t:   time vector
-    :return (V, m, n, h, INa, IK, Il)
+    :param I:           stimulation intensity vector
+    :param t:           time vector
+    :param rateTable:   if given, the rate functions are interpolated from
+        this table instead of being evaluated analytically at each step
+        (see ``hh_rates.getRateTable``)
+    :param method:      integration method, ``'euler'`` (forward Euler, the
+        reference) or ``'rush_larsen'`` (exponential Euler for the gates and
+        semi-implicit update for the voltage, stable for much larger steps)
+    :param stride:      if greater than 1, the integration is performed on
+        every ``stride``-th sample of ``t`` (with ``I`` averaged over each
+        step) and the outputs are linearly interpolated back onto ``t``
+    :param stop:        if given, the integration ends as soon as this
+        condition is met and the outputs only cover ``t[:len(V)]``
+    :param params:      constants of the model (default: ``HHParams()``)
+    :param outputs:     names of the traces to return, in this order, among
+        ``TRACES`` (``'Im'`` being ``INa + IK + Il``). Only these traces are
+        allocated, the others are kept in rolling variables
+    :param dtype:       data type of the returned traces (the integration is
+        always performed in double precision)
+    :param fromRest:    if ``True``, starts from the resting state of the
+        model (see ``restingState``) instead of V = -65 mV with the gates at
+        their steady state, so no pre-stimulus settling time is needed
+    :return (V, m, n, h, INa, IK, Il), or the traces listed in ``outputs``
     """
+    _checkMethod(method)
+    _checkOutputs(outputs)
+    if stride > 1:
+        Ic, tc = _coarsen(I, t, stride)
+        result = hhrun(Ic, tc, rateTable, method, stop=stop, params=params,
+                       outputs=outputs, dtype=dtype, fromRest=fromRest)
+        return _resampleOutputs(result, tc, t, stride)
 
     # def am(v):
     #     # Alpha for Variable m
@@ -112,16 +482,6 @@ def hhrun(I: ndarray, t: ndarray) -> Tuple[ndarray, ...]:
     # I = 0.1                   # External Current Applied
     dt = t[1]-t[0]
 
-    # Array initializations
-    length = len(t)
-    V = zeros(length)
-    m = zeros(length)
-    n = zeros(length)
-    h = zeros(length)
-    INa = zeros(length)
-    IK = zeros(length)
-    Il = zeros(length)
-
     # Cm = 0.01       # Membrane Capcitance uF/cm**2
     # ENa = 55.17     # mv Na reversal potential
     # EK = -72.14     # mv K reversal potential
@@ -141,34 +501,123 @@ def hhrun(I: ndarray, t: ndarray) -> Tuple[ndarray, ...]:
     # gbarl = 0.3/200000  # mS/cm**2 Leakage conductance
     # V[1] = -65          # Initial Membrane voltage
 
-    # params from Gerstner EPFL page (http://icwww.epfl.ch/~gerstner/SPNM/node14.html)
-    Cm = 1          # uF/cm**2 / uF/mm2 divisé par 100, etc
-    ENa = 115-65    # mv Na reversal potential
-    EK = -12-65     # mv K reversal potential
-    El = 10.7-65    # mv Leakage reversal potential
-    gbarNa = 120    # mS/cm**2 Na conductance
-    gbarK = 36      # 36# mS/cm**2 K conductance
-    gbarl = 0.3     # mS/cm**2 Leakage conductance
-    V[0] = -65      # Initial Membrane voltage
-
-    m[0] = am(V[0]) / (am(V[0]) + bm(V[0]))  # Initial m-value
-    n[0] = an(V[0]) / (an(V[0]) + bn(V[0]))  # Initial n-value
-    h[0] = ah(V[0]) / (ah(V[0]) + bh(V[0]))  # Initial h-value
-    for i in range(length - 1):
-        # Euler method to find the next m/n/h value
-        m[i + 1] = m[i] + dt * ((am(V[i]) * (1 - m[i])) - (bm(V[i]) * m[i]))
-        n[i + 1] = n[i] + dt * ((an(V[i]) * (1 - n[i])) - (bn(V[i]) * n[i]))
-        h[i + 1] = h[i] + dt * ((ah(V[i]) * (1 - h[i])) - (bh(V[i]) * h[i]))
-        gNa = gbarNa * m[i] ** 3 * h[i]
-        gK = gbarK * n[i] ** 4
-        gl = gbarl
-        INa[i] = gNa * (V[i] - ENa)
-        IK[i] = gK * (V[i] - EK)
-        Il[i] = gl * (V[i] - El)
-        # Euler method to find the next voltage value
-        V[i + 1] = V[i] + dt * ((1 / Cm) * (I[i] - (INa[i] + IK[i] + Il[i])))
-    INa[i + 1] = gNa * (V[i + 1] - ENa)
-    IK[i + 1] = gK * (V[i + 1] - EK)
-    Il[i + 1] = gl * (V[i + 1] - El)
-
-    return V, m, n, h, INa, IK, Il
+    # params from Gerstner EPFL page by default (see HHParams)
+    p = HHParams() if params is None else params
+    v = -65      # Initial Membrane voltage
+
+    if rateTable is None:
+        def rates(v):
+            return am(v), bm(v), an(v), bn(v), ah(v), bh(v)
+    else:
+        rates = rateTable.scalar
+
+    # gates are kept in rolling variables, written only if requested
+    if fromRest:
+        v, mi, ni, hi = restingState(p)
+    else:
+        a_m, b_m, a_n, b_n, a_h, b_h = rates(v)
+        mi = a_m / (a_m + b_m)  # Initial m-value
+        ni = a_n / (a_n + b_n)  # Initial n-value
+        hi = a_h / (a_h + b_h)  # Initial h-value
+    tracker = None if stop is None else _SpikeTracker(stop, v, dt)
+    return _integrate(I, len(t), dt, v, mi, ni, hi, rates, method, p, stop, tracker, outputs, dtype)
+
+
+def hhrun_batch(I: ndarray, t: ndarray,
+                rateTable: Optional[RateTable] = None,
+                method: str = 'euler',
+                stride: int = 1,
+                stop: Optional[SpikeStop] = None,
+                params: Optional[HHParams] = None,
+                outputs: Sequence[str] = OUTPUTS,
+                dtype=float64,
+                fromRest: bool = False) -> Tuple[ndarray, ...]:
+    """
+    Performs Hodgkin–Huxley algorithm for several stimulation currents at
+    once. Every condition is advanced together at each time step, so the
+    cost of one step is a handful of array operations whatever the number
+    of conditions.
+
+    Each row of the returned arrays matches the output of ``hhrun`` called
+    with the corresponding row of ``I``.
+
+    :param I:           stimulation intensity matrix (n_conditions x n_samples),
+        a 1-D vector is treated as a single condition
+    :param t:           time vector (n_samples)
+    :param rateTable:   if given, the rate functions are interpolated from
+        this table (see ``hh_rates.getRateTable``)
+    :param method:      integration method, ``'euler'`` or ``'rush_larsen'``
+        (see ``hhrun``)
+    :param stride:      integration on every ``stride``-th sample of ``t``,
+        outputs interpolated back onto ``t`` (see ``hhrun``)
+    :param stop:        if given, the integration ends as soon as every
+        condition has met it (see ``hhrun``)
+    :param params:      constants of the model (default: ``HHParams()``),
+        each field being a scalar or an array of n_conditions values
+    :param outputs:     names of the traces to return (see ``hhrun``)
+    :param dtype:       data type of the returned traces
+    :param fromRest:    if ``True``, each condition starts from the resting
+        state of its parameters (see ``hhrun``)
+    :return (V, m, n, h, INa, IK, Il), or the traces listed in ``outputs``,
+        each of shape (n_conditions x n_samples)
+    """
+    _checkMethod(method)
+    _checkOutputs(outputs)
+    I = atleast_2d(I)
+    if stride > 1:
+        Ic, tc = _coarsen(I, t, stride)
+        result = hhrun_batch(Ic, tc, rateTable, method, stop=stop, params=params,
+                             outputs=outputs, dtype=dtype, fromRest=fromRest)
+        return _resampleOutputs(result, tc, t, stride)
+    dt = t[1] - t[0]
+
+    I = I.T
+
+    # params from Gerstner EPFL page by default (see HHParams)
+    p = HHParams() if params is None else params
+    v = full(I.shape[1], -65.)      # Initial Membrane voltage
+
+    rates = hh_rates.rates if rateTable is None else rateTable
+
+    if fromRest:
+        v, mi, ni, hi = _batchRestingState(p, I.shape[1])
+    else:
+        a_m, b_m, a_n, b_n, a_h, b_h = rates(v)
+        mi = a_m / (a_m + b_m)  # Initial m-value
+        ni = a_n / (a_n + b_n)  # Initial n-value
+        hi = a_h / (a_h + b_h)  # Initial h-value
+    tracker = None if stop is None else _BatchSpikeTracker(stop, v, dt)
+    result = _integrate(I, len(t), dt, v, mi, ni, hi, rates, method, p, stop, tracker,
+                        outputs, dtype, shape=(I.shape[1],))
+    return tuple(x.T for x in result)
+
+
+def hhrun_sweep(I: ndarray, t: ndarray, sweep: Dict[str, ndarray],
+                params: Optional[HHParams] = None, **options) -> Tuple[ndarray, ...]:
+    """
+    Performs Hodgkin–Huxley algorithm for every combination of the swept
+    parameter values, in a single vectorized pass (see ``hhrun_batch``).
+
+    Example: ``hhrun_sweep(I, t, {'gbarNa': gNas, 'gbarK': gKs})`` returns
+    arrays of shape (len(gNas), len(gKs), len(t)).
+
+    :param I:           stimulation intensity vector, shared by all conditions
+    :param t:           time vector
+    :param sweep:       values taken by some of the ``HHParams`` fields,
+        the axes of the results follow the order of this dictionary
+    :param params:      values of the other fields (default: ``HHParams()``)
+    :param options:     other keyword arguments of ``hhrun_batch``
+    :return (V, m, n, h, INa, IK, Il), or the traces listed in the
+        ``outputs`` option, each of shape (*sweep shape, n_samples)
+    """
+    params = HHParams() if params is None else params
+    names = list(sweep)
+    unknown = set(names) - {f.name for f in fields(HHParams)}
+    if unknown:
+        raise ValueError(f'unknown HH parameters: {sorted(unknown)}')
+    grids = meshgrid(*[asarray(sweep[name], dtype=float) for name in names], indexing='ij')
+    shape = grids[0].shape if grids else ()
+    swept = replace(params, **{name: grid.ravel() for name, grid in zip(names, grids)})
+    count = grids[0].size if grids else 1
+    result = hhrun_batch(broadcast_to(I, (count, len(I))), t, params=swept, **options)
+    return tuple(x.reshape(shape + x.shape[-1:]) for x in result)
@@ -0,0 +1,180 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from src.core.hh_rates import getRateTable
+from src.core.hhrun import HHParams, SpikeStop, hhrun, hhrun_batch, hhrun_sweep, restingState
+
+
+def _stimulation(t: np.ndarray, amp: float, dur: float, delay: float = 1) -> np.ndarray:
+    return (np.heaviside(t - delay, 1 / 2) - np.heaviside(t - dur - delay, 1 / 2)) * amp
+
+
+def _hhrunLoop(I: np.ndarray, t: np.ndarray):
+    """
+    Reference implementation (forward Euler on full arrays, analytic rates)
+    """
+
+    def am(v):
+        v = v + 65
+        if v == 25:
+            return 1 / 2 * (am(v - 66) + am(v - 64))
+        return (2.5 - 0.1 * v) / (np.exp(2.5 - 0.1 * v) - 1)
+
+    def bm(v):
+        return 4 * np.exp(-(v + 65) / 18)
+
+    def an(v):
+        v = v + 65
+        if v == 10:
+            return 1 / 2 * (an(v - 66) + an(v - 64))
+        return (0.1 - 0.01 * v) / (np.exp(1 - 0.1 * v) - 1)
+
+    def bn(v):
+        return 0.125 * np.exp(-(v + 65) / 80)
+
+    def ah(v):
+        return 0.07 * np.exp(-(v + 65) / 20)
+
+    def bh(v):
+        v = v + 65
+        if v == 30:
+            return 1 / 2 * (bh(v - 66) + bh(v - 64))
+        return 1 / (np.exp(3 - 0.1 * v) + 1)
+
+    p = HHParams()
+    dt = t[1] - t[0]
+    length = len(t)
+    V, m, n, h, INa, IK, Il = np.zeros((7, length))
+    V[0] = -65
+    m[0] = am(V[0]) / (am(V[0]) + bm(V[0]))
+    n[0] = an(V[0]) / (an(V[0]) + bn(V[0]))
+    h[0] = ah(V[0]) / (ah(V[0]) + bh(V[0]))
+    for i in range(length - 1):
+        m[i + 1] = m[i] + dt * ((am(V[i]) * (1 - m[i])) - (bm(V[i]) * m[i]))
+        n[i + 1] = n[i] + dt * ((an(V[i]) * (1 - n[i])) - (bn(V[i]) * n[i]))
+        h[i + 1] = h[i] + dt * ((ah(V[i]) * (1 - h[i])) - (bh(V[i]) * h[i]))
+        gNa = p.gbarNa * m[i] ** 3 * h[i]
+        gK = p.gbarK * n[i] ** 4
+        INa[i] = gNa * (V[i] - p.ENa)
+        IK[i] = gK * (V[i] - p.EK)
+        Il[i] = p.gbarl * (V[i] - p.El)
+        V[i + 1] = V[i] + dt * ((1 / p.Cm) * (I[i] - (INa[i] + IK[i] + Il[i])))
+    INa[-1] = gNa * (V[-1] - p.ENa)
+    IK[-1] = gK * (V[-1] - p.EK)
+    Il[-1] = p.gbarl * (V[-1] - p.El)
+    return V, m, n, h, INa, IK, Il
+
+
+class HhrunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dt = 1 / 1000
+        self.t = np.arange(6000) * self.dt
+        self.I = np.array([
+            _stimulation(self.t, 0, 1),
+            _stimulation(self.t, 20, 2),
+            _stimulation(self.t, 40, 3),
+        ])
+
+    def test_hhrun_batch_matches_hhrun(self):
+        batch = hhrun_batch(self.I, self.t)
+        for row, I in enumerate(self.I):
+            for expected, actual in zip(hhrun(I, self.t), batch):
+                assert_allclose(actual[row], expected, rtol=1e-9, atol=1e-9)
+
+    def test_hhrun_reference(self):
+        batch = hhrun_batch(self.I, self.t)
+        for row, I in enumerate(self.I):
+            expected = _hhrunLoop(I, self.t)
+            for reference, single, batched in zip(expected, hhrun(I, self.t), batch):
+                assert_allclose(single, reference, rtol=1e-12, atol=1e-12)
+                assert_allclose(batched[row], reference, rtol=1e-9, atol=1e-9)
+
+    def test_hhrun_batch_single_vector(self):
+        V, *_ = hhrun_batch(self.I[1], self.t)
+        self.assertEqual(V.shape, (1, len(self.t)))
+
+    def test_rate_table_error_bound(self):
+        self.assertTrue(np.all(getRateTable().maxError() < 2e-7))
+        self.assertTrue(np.all(getRateTable(step=0.1).maxError() < 2e-5))
+        table = getRateTable()
+        self.assertEqual(table(-30.).shape, (6,))
+        assert_allclose(table(-30.), table.scalar(-30.))
+        assert_allclose(table(np.array([-30., 20.]))[:, 0], table(np.float64(-30.)))
+
+    def test_hhrun_rate_table(self):
+        table = getRateTable()
+        V, *_ = hhrun(self.I[2], self.t)
+        Vt, *_ = hhrun(self.I[2], self.t, rateTable=table)
+        assert_allclose(Vt, V, atol=1e-4)
+        Vb, *_ = hhrun_batch(self.I, self.t, rateTable=table)
+        assert_allclose(Vb[2], Vt, atol=1e-9)
+
+    def test_hhrun_rush_larsen_large_step(self):
+        V, *_, INa, IK, Il = hhrun(self.I[2], self.t)
+        Vr, *_, INar, IKr, Ilr = hhrun(self.I[2], self.t, method='rush_larsen', stride=10)
+        self.assertEqual(Vr.shape, V.shape)
+        self.assertLessEqual(abs(np.argmax(Vr) - np.argmax(V)), 50)
+        Im = INa + IK + Il
+        Imr = np.roll(INar + IKr + Ilr, np.argmax(V) - np.argmax(Vr))
+        self.assertLess(np.linalg.norm(Imr - Im) / np.linalg.norm(Im), 0.05)
+        Vb, *_ = hhrun_batch(self.I, self.t, method='rush_larsen', stride=10)
+        assert_allclose(Vb[2], Vr, atol=1e-9)
+
+    def test_hhrun_spike_stop(self):
+        full = hhrun(self.I[2], self.t)
+        stop = SpikeStop(after=1, chunk=1000)
+        stopped = hhrun(self.I[2], self.t, stop=stop)
+        length = len(stopped[0])
+        self.assertLess(length, len(self.t))
+        self.assertGreaterEqual((length - 1 - np.argmax(full[0])) * self.dt, 1)
+        for expected, actual in zip(full, stopped):
+            assert_allclose(actual, expected[:length])
+        # rows which do not spike never stop the batch
+        V, *_ = hhrun_batch(self.I[:2], self.t, stop=stop)
+        self.assertEqual(V.shape, (2, len(self.t)))
+
+    def test_hhrun_sweep(self):
+        gNas = np.array([80., 120.])
+        gKs = np.array([30., 36., 40.])
+        V, *_, Il = hhrun_sweep(self.I[2], self.t, {'gbarNa': gNas, 'gbarK': gKs})
+        self.assertEqual(V.shape, (2, 3, len(self.t)))
+        expected, *_ = hhrun(self.I[2], self.t, params=HHParams(gbarNa=80, gbarK=40))
+        assert_allclose(V[0, 2], expected, rtol=1e-9, atol=1e-9)
+        with self.assertRaises(ValueError):
+            hhrun_sweep(self.I[2], self.t, {'gNa': gNas})
+
+    def test_hhrun_outputs(self):
+        V, m, n, h, INa, IK, Il = hhrun(self.I[2], self.t)
+        Im, V2 = hhrun(self.I[2], self.t, outputs=('Im', 'V'), dtype=np.float32)
+        self.assertEqual(V2.dtype, np.float32)
+        assert_allclose(V2, V, rtol=1e-6)
+        assert_allclose(Im, INa + IK + Il, rtol=1e-5, atol=1e-3)
+        Imb, = hhrun_batch(self.I, self.t, outputs=('Im',))
+        assert_allclose(Imb[2], INa + IK + Il, rtol=1e-9, atol=1e-9)
+        with self.assertRaises(ValueError):
+            hhrun(self.I[2], self.t, outputs=('Vm',))
+
+    def test_resting_state(self):
+        params = HHParams(gbarK=30)
+        V, m, n, h = restingState(params)
+        self.assertAlmostEqual(V, -64.25, places=2)
+        self.assertIs(restingState(params), restingState(HHParams(gbarK=30)))
+        # the resting state is a fixed point of the integration
+        Vr, mr, *_ = hhrun(self.I[0], self.t, params=params, fromRest=True)
+        assert_allclose(Vr, V, atol=1e-9)
+        assert_allclose(mr, m, atol=1e-9)
+        Vb, *_ = hhrun_batch(self.I[:2], self.t, fromRest=True,
+                             params=HHParams(gbarK=np.array([30., 36.])))
+        assert_allclose(Vb[0], Vr, atol=1e-9)
+        self.assertAlmostEqual(Vb[1, 0], restingState()[0])
+
+    def test_hhrun_unknown_method(self):
+        with self.assertRaises(ValueError):
+            hhrun(self.I[0], self.t, method='rk4')
+
+
+if __name__ == '__main__':
+    unittest.main()
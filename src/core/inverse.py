@@ -0,0 +1,259 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module estimates the position and orientation of a neuron from its
+extracellular action potentials (EAP), with the morphological filter as
+forward model.
+
+The EAP of a geometry is linear in its filter, ``V = W @ B``, ``B`` being
+the membrane current shifted by each tap of the upsampled filter. The
+squared error between an observation ``Y`` and a prediction therefore only
+needs ``Y @ B.T`` (per observation) and the Gram matrix ``B @ B.T``, so
+thousands of hypotheses are scored from their (M x order) filters without
+computing their EAPs. The somatic amplitude ``Cs`` (and optionally an
+overall gain) enters linearly and is solved in closed form for every
+hypothesis.
+
+Candidates are scored on a grid of positions and directions, then the best
+ones are refined by a batched compass search on the position and on the
+angles of the axon.
+
+@author: Loïc Bertrand, Tony Zhou
+"""
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+
+from src.core.convolution import convolveElectrodes
+from src.core.morphofiltd import chunks, morphofiltdPopulation
+
+
+@dataclass
+class CellShape:
+    """
+    Ball and stick geometry of the localized cell
+    """
+    SL: float = 25  # soma length (μm)
+    AL: float = 1000  # axon length (μm)
+    dk: float = 10  # axonal spatial sampling (μm)
+
+    @property
+    def order(self) -> int:
+        return int(self.AL / self.dk + 1)
+
+    def geometry(self, r0: np.ndarray, direction: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :param r0:          soma positions (H x 3)
+        :param direction:   unit vectors of the axons (H x 3)
+        :return:            ``r1``, ``rN`` and ``rD`` of ``morphofiltdPopulation``,
+            the dendrite being opposite to the axon start as in the demos
+        """
+        r1 = r0 + self.SL / 2 * direction
+        rN = r1 + (self.AL - self.dk) * direction
+        return r1, rN, r0 - (r1 - r0)
+
+
+@dataclass
+class Localization:
+    r0: np.ndarray  # soma position of each unit (U x 3)
+    direction: np.ndarray  # unit vector of the axon of each unit (U x 3)
+    Cs: np.ndarray  # amplitude of the somatic dipole of each unit (U)
+    gain: np.ndarray  # overall gain of each unit (U), 1 unless fitted
+    error: np.ndarray  # relative squared error of each unit (U)
+
+
+def directions(n: int) -> np.ndarray:
+    """
+    :param n:   number of directions
+    :return:    unit vectors spread uniformly on the sphere (n x 3)
+        (Fibonacci lattice)
+    """
+    i = np.arange(n) + 0.5
+    z = 1 - 2 * i / n
+    rho = np.sqrt(1 - z ** 2)
+    theta = np.pi * (1 + 5 ** 0.5) * i
+    return np.stack([rho * np.cos(theta), rho * np.sin(theta), z], axis=1)
+
+
+def _toAngles(u: np.ndarray) -> np.ndarray:
+    return np.stack([np.arctan2(u[:, 1], u[:, 0]), np.arccos(np.clip(u[:, 2], -1, 1))], axis=1)
+
+
+def _fromAngles(angles: np.ndarray) -> np.ndarray:
+    theta, phi = angles[:, 0], angles[:, 1]
+    return np.stack([np.sin(phi) * np.cos(theta), np.sin(phi) * np.sin(theta), np.cos(phi)], axis=1)
+
+
+class InverseSolver:
+    """
+    Localizes units recorded by a set of electrodes, for a given membrane
+    current template
+    """
+
+    def __init__(self, re: np.ndarray, Im: np.ndarray, taus: int,
+                 shape: Optional[CellShape] = None, fitGain: bool = False):
+        """
+        :param re:      electrode positions (M x 3)
+        :param Im:      membrane current template (nA)
+        :param taus:    upsampling factor of the filters
+        :param shape:   geometry of the cells (default: ``CellShape()``)
+        :param fitGain: if ``True``, the observations are compared up to a
+            gain (e.g. if they are not in the units of the forward model)
+        """
+        self.re = np.array(re, dtype=float, ndmin=2)
+        shape = CellShape() if shape is None else shape
+        self.shape = shape
+        self.fitGain = fitGain
+        order = shape.order
+        # EAP of a unit weight on each tap
+        self.basis = convolveElectrodes(np.asarray(Im, dtype=float), np.eye(order), taus)
+        self.gram = self.basis @ self.basis.T
+
+    def weights(self, r0: np.ndarray, direction: np.ndarray) -> np.ndarray:
+        """
+        Filters of straight ball and stick cells (``morphofiltdPopulation``
+        with ``Cs = 1``).
+
+        :param r0:          soma positions of the hypotheses (H x 3)
+        :param direction:   unit vectors of their axons (H x 3)
+        :return:            filters of the hypotheses (H x M x order)
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return morphofiltdPopulation(self.re, self.shape.order, r0, *self.shape.geometry(r0, direction))
+
+    def project(self, Y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param Y:   observed EAPs (U x M x N), aligned with the template
+        :return:    projections on the basis (U x M x order) and squared norms (U)
+        """
+        Y = np.asarray(Y, dtype=float)
+        if Y.ndim == 2:
+            Y = Y[None]
+        return Y @ self.basis.T, (Y ** 2).sum(axis=(1, 2))
+
+    def _solve(self, ys, ya, yy, W):
+        """
+        Least squares of ``Cs`` (and of the gain) for the hypotheses ``W``,
+        ``ys`` and ``ya`` being the products of the observations with their
+        somatic and axonal EAPs (broadcast against the hypotheses).
+        """
+        w0, wax = W[..., 0], W[..., 1:]
+        G = self.gram
+        ss = G[0, 0] * (w0 ** 2).sum(axis=-1)
+        sa = (w0 * (wax @ G[1:, 0])).sum(axis=-1)
+        aa = ((wax @ G[1:, 1:]) * wax).sum(axis=(-2, -1))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.fitGain:
+                det = ss * aa - sa ** 2
+                a = (aa * ys - sa * ya) / det
+                b = (ss * ya - sa * ys) / det
+                cost = yy - a * ys - b * ya
+                Cs, gain = a / b, b
+            else:
+                Cs = (ys - sa) / ss
+                cost = yy - 2 * ya + aa - (ys - sa) * Cs
+                gain = np.ones_like(Cs)
+        # degenerate hypotheses (electrode on a compartment) are discarded
+        return np.where(np.isfinite(cost), cost, np.inf), Cs, gain
+
+    def scores(self, Y: np.ndarray, r0: np.ndarray, direction: np.ndarray,
+               chunkSize: int = 128):
+        """
+        Scores every hypothesis against every observation.
+
+        :param Y:           observed EAPs (U x M x N)
+        :param r0:          soma positions of the hypotheses (H x 3)
+        :param direction:   unit vectors of their axons (H x 3)
+        :param chunkSize:   number of hypotheses evaluated at once
+        :return:            squared errors, ``Cs`` and gains (U x H each)
+        """
+        YB, yy = self.project(Y)
+        r0 = np.array(r0, dtype=float, ndmin=2)
+        direction = np.array(direction, dtype=float, ndmin=2)
+        result = np.empty((3, len(YB), len(r0)))
+        for start, stop in chunks(len(r0), chunkSize):
+            W = self.weights(r0[start:stop], direction[start:stop])
+            ys = YB[..., 0] @ W[..., 0].T
+            ya = np.einsum('umk,hmk->uh', YB[..., 1:], W[..., 1:])
+            result[:, :, start:stop] = self._solve(ys, ya, yy[:, None], W[None])
+        return tuple(result)
+
+    def _pairedCost(self, YB, yy, r0, angles):
+        """
+        Scores the hypotheses ``(r0[h, j], angles[h, j])`` against the
+        observation ``h`` (projections ``YB[h]``, squared norm ``yy[h]``).
+        """
+        H, J = r0.shape[:2]
+        W = self.weights(r0.reshape(-1, 3), _fromAngles(angles.reshape(-1, 2)))
+        W = W.reshape((H, J) + W.shape[1:])
+        ys = np.einsum('hm,hjm->hj', YB[..., 0], W[..., 0])
+        ya = np.einsum('hmk,hjmk->hj', YB[..., 1:], W[..., 1:])
+        return self._solve(ys, ya, yy[:, None], W)
+
+    def localize(self, Y: np.ndarray, r0: np.ndarray, direction: np.ndarray,
+                 best: int = 3, iterations: int = 40,
+                 step: Tuple[float, float] = (10, 0.2), tol: float = 0.05,
+                 chunkSize: int = 128) -> Localization:
+        """
+        Localizes each observed unit: the hypotheses are scored, then the
+        ``best`` ones of each unit are refined together by a compass search
+        (each parameter moved by ± its step, steps halved when no move
+        improves) until their position step falls below ``tol``.
+
+        :param Y:           observed EAPs (U x M x N), or (M x N) for one unit
+        :param r0:          candidate soma positions (H x 3)
+        :param direction:   candidate axon directions (H x 3), paired with ``r0``
+        :param best:        number of candidates refined per unit
+        :param iterations:  maximum number of iterations of the compass search
+        :param step:        initial steps of the position (μm) and of the
+            angles (rad)
+        :param tol:         position step (μm) at which a candidate has converged
+        :param chunkSize:   number of hypotheses evaluated at once, bounds the
+            size of the temporary arrays
+        :return:            the localization of each unit
+        """
+        YB, yy = self.project(Y)
+        U = len(YB)
+        cost, _, _ = self.scores(Y, r0, direction, chunkSize)
+        best = min(best, cost.shape[1])
+        top = np.argsort(cost, axis=1)[:, :best].ravel()
+        unit = np.repeat(np.arange(U), best)
+        # parameters: x, y, z, theta, phi
+        params = np.concatenate([np.asarray(r0, dtype=float)[top],
+                                 _toAngles(np.asarray(direction, dtype=float)[top])], axis=1)
+        steps = np.tile(np.repeat(step, (3, 2)).astype(float), (len(params), 1))
+        moves = np.concatenate([np.eye(5), -np.eye(5)])
+        current, Cs, gain = np.empty((3, len(params)))
+        for start, stop in chunks(len(params), chunkSize):
+            rows = np.arange(start, stop)
+            result = self._pairedCost(YB[unit[rows]], yy[unit[rows]],
+                                      params[rows, None, :3], params[rows, None, 3:])
+            current[rows], Cs[rows], gain[rows] = (x[:, 0] for x in result)
+        for _ in range(iterations):
+            active = np.flatnonzero(steps[:, 0] >= tol)
+            if not len(active):
+                break
+            for start, stop in chunks(len(active), max(1, chunkSize // len(moves))):
+                rows = active[start:stop]
+                trial = params[rows, None, :] + moves[None] * steps[rows, None, :]  # (h x 10 x 5)
+                cost, trialCs, trialGain = self._pairedCost(YB[unit[rows]], yy[unit[rows]],
+                                                            trial[..., :3], trial[..., 3:])
+                i = np.argmin(cost, axis=1)
+                sel = np.arange(len(rows))
+                better = cost[sel, i] < current[rows]
+                improved = rows[better]
+                params[improved] = trial[sel, i][better]
+                current[improved] = cost[sel, i][better]
+                Cs[improved] = trialCs[sel, i][better]
+                gain[improved] = trialGain[sel, i][better]
+                steps[rows[~better]] /= 2
+        # best refined candidate of each unit
+        pick = np.argmin(current.reshape(U, best), axis=1) + np.arange(U) * best
+        return Localization(
+            r0=params[pick, :3],
+            direction=_fromAngles(params[pick, 3:]),
+            Cs=Cs[pick],
+            gain=gain[pick],
+            error=current[pick] / yy[unit[pick]],
+        )
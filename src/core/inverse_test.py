@@ -0,0 +1,58 @@
+import unittest
+
+import numpy as np
+from numpy.testing import assert_allclose
+
+from src.core.convolution import convolveElectrodes
+from src.core.inverse import CellShape, InverseSolver, directions
+from src.core.morphofiltd import morphofiltd
+
+
+class InverseTest(unittest.TestCase):
+
+    def setUp(self):
+        # two planes of electrodes on both sides of the cells
+        x, y = np.meshgrid(np.linspace(-100, 700, 9), np.linspace(-100, 100, 5))
+        self.re = np.concatenate([np.stack([x.ravel(), y.ravel(), np.full(x.size, z)], axis=1)
+                                  for z in (-150., 150.)])
+        t = np.arange(2000)
+        self.Im = np.exp(-((t - 1000) / 40) ** 2) - 0.5 * np.exp(-((t - 1100) / 80) ** 2)
+        self.shape = CellShape(AL=300)
+        self.solver = InverseSolver(self.re, self.Im, 5, self.shape)
+
+    def test_weights_match_morphofiltd(self):
+        r0 = np.array([[10., 20., 30.], [200., -50., 0.]])
+        u = directions(2)
+        s = self.shape
+        W = self.solver.weights(r0, u)
+        for h in range(len(r0)):
+            r1 = r0[h] + s.SL / 2 * u[h]
+            expected = morphofiltd(self.re, s.order, r0[h], r1, r1 + (s.AL - s.dk) * u[h], r0[h] - s.SL / 2 * u[h])
+            assert_allclose(W[h], expected, rtol=1e-12)
+
+    def test_localize(self):
+        r0 = np.array([[130., 20., 10.], [60., -30., -20.]])
+        u = np.array([[0.95, 0.3, 0.1], [-0.2, 0.97, -0.1]])
+        u /= np.linalg.norm(u, axis=1, keepdims=True)
+        W = self.solver.weights(r0, u)
+        Cs = np.array([2., 0.5])
+        W[:, :, 0] *= Cs[:, None]
+        Y = np.stack([convolveElectrodes(self.Im, w, 5) for w in W])
+
+        grid = np.stack(np.meshgrid(np.arange(0., 201, 50), np.arange(-50., 51, 50),
+                                    np.arange(-25., 26, 25)), axis=-1).reshape(-1, 3)
+        d = directions(100)
+        hypotheses = np.repeat(grid, len(d), axis=0), np.tile(d, (len(grid), 1))
+        loc = self.solver.localize(Y, *hypotheses)
+        self.assertTrue(np.all(np.linalg.norm(loc.r0 - r0, axis=1) < 10))
+        self.assertTrue(np.all((loc.direction * u).sum(axis=1) > 0.99))
+        assert_allclose(loc.Cs, Cs, rtol=0.1)
+        self.assertTrue(np.all(loc.error < 1e-2))
+        # the chunks only bound the memory
+        chunked = self.solver.localize(Y, *hypotheses, chunkSize=7)
+        assert_allclose(chunked.r0, loc.r0)
+        assert_allclose(chunked.error, loc.error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,12 +4,39 @@
 @author: Loïc Bertrand, Steven Le Cam, Radu Ranta, Tony Zhou
 """
 
-from numpy import array, dot, linspace, ndarray, pi, zeros
-from numpy.linalg import norm
+from dataclasses import dataclass
+from typing import Iterator, Optional, Sequence, Tuple
+
+from numpy import (add, arange, argsort, array, broadcast_to, ceil, concatenate, cumsum, empty, float_power,
+                   floor, interp, linspace, minimum, ndarray, pi, sqrt, unique)
+
+COND = 0.33  # extracellular conductivity (S/m)
+
+
+def _dipoles(re: ndarray, origins: ndarray, moments: ndarray, amplitude=1) -> ndarray:
+    """
+    Potential of current dipoles at every electrode
+
+    :param re:          electrode positions (M x 3)
+    :param origins:     dipole positions (K x 3), or (C x K x 3) for C cells
+    :param moments:     dipole directions (same shape as ``origins``)
+    :param amplitude:   amplitude of the dipoles (default: 1), broadcast
+        against the result
+    :return:            potentials (M x K), or (C x M x K)
+    """
+    d = re[:, None, :, None] - origins[..., None, :, :, None]  # column vectors
+    dT = d.swapaxes(-1, -2)
+    # matmul evaluates the 3-term products like dot() and norm() do, and
+    # float_power the cube like a scalar power, so the result is identical
+    # to the electrode by electrode computation
+    proj = -amplitude * (dT @ moments[..., None, :, :, None])[..., 0, 0]
+    dist = sqrt((dT @ d)[..., 0, 0])
+    return proj / (4 * pi * COND * float_power(dist, 3))
 
 
 def morphofiltd(re: ndarray, order: int, r0: ndarray, r1: ndarray,
-                rN: ndarray, rD: ndarray = None, Cs=1) -> ndarray:
+                rN: ndarray, rD: ndarray = None, Cs=1,
+                chunkSize: Optional[int] = None, out: Optional[ndarray] = None) -> ndarray:
     """
     Performs morphological filtering approximation
 
@@ -20,32 +47,244 @@ def morphofiltd(re: ndarray, order: int, r0: ndarray, r1: ndarray,
     :param rN:      last axon compartment position (1 x 3) (beginning)
     :param rD:      tip of the equivalent dendrite (default: None)
     :param Cs:      amplitude of the somatic dipole (default: 1)
+    :param chunkSize:   number of electrodes processed at once (default: all),
+        bounds the size of the temporary arrays
+    :param out:     preallocated (M x order) result, e.g. a ``numpy.memmap``
+        (default: a new array)
     :return:        filtered result
     """
 
     if rD is None:
         rD = r1
-    cond = 0.33
-    M = re.shape[0]
     rk = array([
         linspace(r1[0], rN[0], order - 1),
         linspace(r1[1], rN[1], order - 1),
         linspace(r1[2], rN[2], order - 1)
     ]).T
-    w = zeros([M, order])
-    for iel in range(M):
-        for ik in range(1, order - 1):
-            w[iel, ik] = (
-                    dot(-(re[iel] - rk[ik - 1]), (rk[ik] - rk[ik - 1]))
-                    / (4 * pi * cond * norm(re[iel] - rk[ik - 1]) ** 3)
-            )
-        w[iel, order - 1] = (
-                dot(-(re[iel] - rk[order - 2]), (rk[order - 2] - rk[order - 3]))
-                / (4 * pi * cond * norm(re[iel] - rk[order - 2]) ** 3)
-        )
-        w[iel, 0] = (
-                -Cs * dot((re[iel] - r0), (rD - r0))
-                / (4 * pi * cond * norm(re[iel] - r0) ** 3)
-        )
-
-    return w
+    return morphofiltdPath(re, rk, r0, rD, Cs, chunkSize, out)
+
+
+def morphofiltdPath(re: ndarray, rk: ndarray, r0: ndarray, rD: ndarray = None, Cs=1,
+                    chunkSize: Optional[int] = None, out: Optional[ndarray] = None) -> ndarray:
+    """
+    Performs morphological filtering approximation for an axon following
+    an arbitrary path (see ``resamplePath``), ``morphofiltd`` being the
+    special case of a straight axon.
+
+    :param re:      electrode positions (M x 3)
+    :param rk:      beginning of each axon compartment (N x 3), at least 2
+    :param r0:      soma position (1 x 3) (center)
+    :param rD:      tip of the equivalent dendrite (default: ``rk[0]``)
+    :param Cs:      amplitude of the somatic dipole (default: 1)
+    :param chunkSize:   number of electrodes processed at once (default: all)
+    :param out:     preallocated (M x N+1) result (default: a new array)
+    :return:        filtered result (M x N+1)
+    """
+    rk = array(rk, dtype=float)
+    if len(rk) < 2:
+        raise ValueError(f'the axon needs at least 2 compartments: {len(rk)}')
+    if rD is None:
+        rD = rk[0]
+    re = array(re, dtype=float, ndmin=2)
+    r0 = array(r0, dtype=float)
+    order = len(rk) + 1
+    # axon compartment k is a dipole at rk[k - 1] directed along the axon,
+    # the last one keeping the direction of the previous segment
+    steps = rk[1:] - rk[:-1]
+    moments = concatenate([steps, steps[-1:]])
+    somaMoment = (rD - r0)[None]
+    M = re.shape[0]
+    if out is None:
+        out = empty((M, order))
+    elif out.shape != (M, order):
+        raise ValueError(f'out must be of shape {(M, order)}: {out.shape}')
+    for start, stop in chunks(M, chunkSize):
+        block = re[start:stop]
+        out[start:stop, 0] = _dipoles(block, r0[None], somaMoment, Cs)[:, 0]
+        out[start:stop, 1:] = _dipoles(block, rk, moments)
+    return out
+
+
+def morphofiltdPopulation(re: ndarray, order: int, r0: ndarray, r1: ndarray,
+                          rN: ndarray, rD: ndarray = None, Cs=1,
+                          chunkSize: Optional[int] = None, out: Optional[ndarray] = None) -> ndarray:
+    """
+    Performs morphological filtering approximation for a population of C
+    cells at once, each cell having its own position and orientation. Row
+    ``c`` of the result is ``morphofiltd`` of cell ``c``.
+
+    :param re:      electrode positions (M x 3)
+    :param order:   filter length, common to the cells
+    :param r0:      soma position of each cell (C x 3) (center)
+    :param r1:      axon hillock position of each cell (C x 3) (beginning)
+    :param rN:      last axon compartment position of each cell (C x 3)
+    :param rD:      tip of the equivalent dendrite of each cell (C x 3)
+        (default: ``r1``)
+    :param Cs:      amplitude of the somatic dipole of each cell (C) or of
+        all the cells (default: 1)
+    :param chunkSize:   number of electrodes processed at once (default: all),
+        the temporary arrays being proportional to ``C * chunkSize * order``
+    :param out:     preallocated (C x M x order) result, e.g. a
+        ``numpy.memmap`` (default: a new array)
+    :return:        filters of each cell at each electrode (C x M x order)
+    """
+    r0 = array(r0, dtype=float, ndmin=2)
+    r1 = array(r1, dtype=float, ndmin=2)
+    rN = array(rN, dtype=float, ndmin=2)
+    rD = r1 if rD is None else array(rD, dtype=float, ndmin=2)
+    C = len(r0)
+    Cs = broadcast_to(Cs, (C,))
+    re = array(re, dtype=float, ndmin=2)
+    rk = linspace(r1, rN, order - 1, axis=1)
+    steps = rk[:, 1:] - rk[:, :-1]
+    moments = concatenate([steps, steps[:, -1:]], axis=1)
+    somaMoment = (rD - r0)[:, None]
+    M = re.shape[0]
+    if out is None:
+        out = empty((C, M, order))
+    elif out.shape != (C, M, order):
+        raise ValueError(f'out must be of shape {(C, M, order)}: {out.shape}')
+    for start, stop in chunks(M, chunkSize):
+        block = re[start:stop]
+        out[:, start:stop, 0] = _dipoles(block, r0[:, None], somaMoment, Cs[:, None, None])[..., 0]
+        out[:, start:stop, 1:] = _dipoles(block, rk, moments)
+    return out
+
+
+def resamplePath(points: ndarray, dk: float) -> ndarray:
+    """
+    Splits a polyline (e.g. the 3D points of an axon section) in
+    compartments of length ``dk`` along its arc length, the remainder
+    shorter than ``dk`` being dropped.
+
+    :param points:  vertices of the polyline (P x 3)
+    :param dk:      length of the compartments (μm)
+    :return:        beginning of each compartment (N x 3)
+
+    Examples
+    --------
+    >>> resamplePath(array([[0, 0, 0], [20, 0, 0], [20, 25, 0]]), 10)
+    array([[ 0.,  0.,  0.],
+           [10.,  0.,  0.],
+           [20.,  0.,  0.],
+           [20., 10.,  0.]])
+    """
+    if dk <= 0:
+        raise ValueError('dk must be positive: ' + str(dk))
+    points = array(points, dtype=float, ndmin=2)
+    s = _arcLength(points)
+    count = int(floor(s[-1] / dk + 1e-9))
+    return _pointsAt(points, s, arange(count) * dk)
+
+
+def _arcLength(points: ndarray) -> ndarray:
+    """
+    :return:    arc length of a polyline at each of its vertices
+    """
+    return concatenate([[0], cumsum(sqrt(((points[1:] - points[:-1]) ** 2).sum(axis=1)))])
+
+
+def _pointsAt(points: ndarray, s: ndarray, sk: ndarray) -> ndarray:
+    """
+    :return:    points of the polyline at the arc lengths ``sk``
+    """
+    return array([interp(sk, s, points[:, i]) for i in range(3)]).reshape(3, -1).T
+
+
+@dataclass
+class Branch:
+    """
+    Section of a cell tree, as used by ``morphofiltdTree``
+    """
+    points: ndarray  # 3D points (P x 3), from the end closest to the soma
+    offset: float = 0  # path distance from the soma to the first point (μm)
+
+
+def _branchCompartments(branch: Branch, dk: float) -> Tuple[ndarray, ndarray, ndarray]:
+    """
+    Splits a branch in compartments of length ``dk``, the last one being
+    shorter if needed.
+
+    :return:    beginning (K x 3), dipole moment (K x 3) and filter tap of
+        each compartment (1 for the compartments starting at the soma)
+    """
+    points = array(branch.points, dtype=float, ndmin=2)
+    s = _arcLength(points)
+    count = int(ceil(s[-1] / dk - 1e-9)) if s[-1] > 0 else 0
+    sk = arange(count) * dk
+    origins = _pointsAt(points, s, sk)
+    moments = _pointsAt(points, s, minimum(sk + dk, s[-1])) - origins
+    taps = 1 + int(round(branch.offset / dk)) + arange(count)
+    return origins, moments, taps
+
+
+def morphofiltdTree(re: ndarray, branches: Sequence[Branch], r0: ndarray, dk: float,
+                    rD: ndarray = None, Cs=1,
+                    chunkSize: Optional[int] = None, out: Optional[ndarray] = None) -> ndarray:
+    """
+    Performs morphological filtering approximation for a branched cell
+    (axon collaterals, dendrites): every branch is split in compartments of
+    length ``dk``, and each compartment contributes to the filter tap given
+    by its path distance from the soma, so compartments reached at the same
+    time by the action potential are summed. The dipoles of all the branches
+    are evaluated in a single pass.
+
+    With a single straight branch, the result matches ``morphofiltd``.
+
+    :param re:          electrode positions (M x 3)
+    :param branches:    branches of the cell, without the soma
+    :param r0:          soma position (1 x 3) (center)
+    :param dk:          length of the compartments (μm)
+    :param rD:          tip of the equivalent dendrite (default: beginning of
+        the first branch)
+    :param Cs:          amplitude of the somatic dipole (default: 1)
+    :param chunkSize:   number of electrodes processed at once (default: all)
+    :param out:         preallocated (M x order) result (default: a new array)
+    :return:            filtered result (M x order), ``order - 1`` being the
+        largest tap
+    """
+    if dk <= 0:
+        raise ValueError('dk must be positive: ' + str(dk))
+    parts = [_branchCompartments(branch, dk) for branch in branches]
+    origins = concatenate([p[0] for p in parts] + [empty((0, 3))])
+    if len(origins) == 0:
+        raise ValueError('the branches contain no compartment')
+    moments = concatenate([p[1] for p in parts])
+    taps = concatenate([p[2] for p in parts])
+    if rD is None:
+        rD = origins[0]
+    re = array(re, dtype=float, ndmin=2)
+    r0 = array(r0, dtype=float)
+    order = taps.max() + 1
+    # compartments sorted by tap, summed by groups
+    idx = argsort(taps, kind='stable')
+    origins, moments, taps = origins[idx], moments[idx], taps[idx]
+    usedTaps, starts = unique(taps, return_index=True)
+    somaMoment = (rD - r0)[None]
+    M = re.shape[0]
+    if out is None:
+        out = empty((M, order))
+    elif out.shape != (M, order):
+        raise ValueError(f'out must be of shape {(M, order)}: {out.shape}')
+    for start, stop in chunks(M, chunkSize):
+        block = re[start:stop]
+        out[start:stop] = 0
+        out[start:stop, 0] = _dipoles(block, r0[None], somaMoment, Cs)[:, 0]
+        out[start:stop, usedTaps] = add.reduceat(_dipoles(block, origins, moments), starts, axis=1)
+    return out
+
+
+def chunks(size: int, chunkSize: Optional[int] = None) -> Iterator[Tuple[int, int]]:
+    """
+    Splits ``range(size)`` in consecutive blocks.
+
+    :param size:        number of items
+    :param chunkSize:   number of items per block (default: a single block)
+    :return:            iterator over the (start, stop) bounds of the blocks
+    """
+    if chunkSize is None:
+        chunkSize = max(size, 1)
+    elif chunkSize <= 0:
+        raise ValueError('chunkSize must be positive: ' + str(chunkSize))
+    for start in range(0, size, chunkSize):
+        yield start, min(start + chunkSize, size)
@@ -0,0 +1,119 @@
+import unittest
+
+import numpy as np
+from numpy import dot, linspace, pi, zeros
+from numpy.linalg import norm
+from numpy.testing import assert_allclose, assert_array_equal
+
+from src.core.morphofiltd import (Branch, morphofiltd, morphofiltdPath, morphofiltdPopulation, morphofiltdTree,
+                                  resamplePath)
+
+
+def _morphofiltdLoop(re, order, r0, r1, rN, rD=None, Cs=1):
+    """
+    Reference implementation (electrode by electrode, compartment by
+    compartment)
+    """
+    if rD is None:
+        rD = r1
+    cond = 0.33
+    M = re.shape[0]
+    rk = np.array([
+        linspace(r1[0], rN[0], order - 1),
+        linspace(r1[1], rN[1], order - 1),
+        linspace(r1[2], rN[2], order - 1)
+    ]).T
+    w = zeros([M, order])
+    for iel in range(M):
+        for ik in range(1, order - 1):
+            w[iel, ik] = (
+                    dot(-(re[iel] - rk[ik - 1]), (rk[ik] - rk[ik - 1]))
+                    / (4 * pi * cond * norm(re[iel] - rk[ik - 1]) ** 3)
+            )
+        w[iel, order - 1] = (
+                dot(-(re[iel] - rk[order - 2]), (rk[order - 2] - rk[order - 3]))
+                / (4 * pi * cond * norm(re[iel] - rk[order - 2]) ** 3)
+        )
+        w[iel, 0] = (
+                -Cs * dot((re[iel] - r0), (rD - r0))
+                / (4 * pi * cond * norm(re[iel] - r0) ** 3)
+        )
+    return w
+
+
+class MorphofiltdTest(unittest.TestCase):
+
+    def setUp(self):
+        # default grid of the application (13 x 5 electrodes)
+        x, y = np.meshgrid(np.linspace(-100, 1100, 13), np.linspace(-100, 100, 5))
+        self.re = np.stack([x.ravel(), y.ravel(), np.full(x.size, 25.)], axis=1)
+        self.r0 = np.array([0, 0, 0])
+        self.r1 = np.array([12.5, 0, 0])
+        self.rN = np.array([1002.5, 0, 0])
+
+    def test_matches_loop(self):
+        expected = _morphofiltdLoop(self.re, 101, self.r0, self.r1, self.rN)
+        assert_array_equal(morphofiltd(self.re, 101, self.r0, self.r1, self.rN), expected)
+
+    def test_matches_loop_oblique(self):
+        rng = np.random.default_rng(0)
+        re = rng.uniform(-500, 500, (50, 3))
+        rN = np.array([300., -400., 200.])
+        rD = np.array([-5., 8., 10.])
+        expected = _morphofiltdLoop(re, 37, self.r0, self.r1, rN, rD, Cs=2.5)
+        assert_array_equal(morphofiltd(re, 37, self.r0, self.r1, rN, rD, Cs=2.5), expected)
+
+    def test_path_straight_axon(self):
+        rk = resamplePath(np.array([self.r1, [1012.5, 0, 0]]), 10)
+        self.assertEqual(len(rk), 100)
+        assert_allclose(rk[-1], self.rN)
+        assert_allclose(morphofiltdPath(self.re, rk, self.r0),
+                        morphofiltd(self.re, 101, self.r0, self.r1, self.rN), rtol=1e-12)
+
+    def test_path_bent_axon(self):
+        # the compartments of the second branch are directed along y
+        rk = resamplePath(np.array([self.r1, [112.5, 0, 0], [112.5, 100, 0]]), 10)
+        w = morphofiltdPath(self.re, rk, self.r0)
+        bent = np.array([112.5, 0, 0]) + np.array([[0, 100, 0], [0, -100, 0]])
+        wb = morphofiltdPath(bent, rk, self.r0)
+        self.assertEqual(w.shape, (len(self.re), 21))
+        self.assertGreater(wb[1, 15], 0)
+        self.assertLess(wb[0, 15], 0)
+
+    def test_tree_single_branch(self):
+        axon = Branch(np.array([self.r1, [1012.5, 0, 0]]))
+        assert_allclose(morphofiltdTree(self.re, [axon], self.r0, 10),
+                        morphofiltd(self.re, 101, self.r0, self.r1, self.rN), rtol=1e-12)
+
+    def test_tree_sums_branches(self):
+        axon = Branch(np.array([self.r1, [212.5, 0, 0]]))
+        dendrite = Branch(np.array([-self.r1, [-62.5, 0, 0]]))
+        collateral = Branch(np.array([[112.5, 0, 0], [112.5, 35, 0]]), offset=100)
+        w = morphofiltdTree(self.re, [axon, dendrite, collateral], self.r0, 10, rD=-self.r1)
+        self.assertEqual(w.shape, (len(self.re), 21))
+        wa = morphofiltdTree(self.re, [axon], self.r0, 10, rD=-self.r1)
+        wd = morphofiltdTree(self.re, [dendrite], self.r0, 10, rD=-self.r1, Cs=0)
+        wc = morphofiltdTree(self.re, [collateral], self.r0, 10, rD=-self.r1, Cs=0)
+        expected = wa.copy()
+        expected[:, :wd.shape[1]] += wd
+        expected[:, :wc.shape[1]] += wc
+        assert_allclose(w, expected, rtol=1e-12, atol=1e-20)
+        # the collateral starts at tap 11 and its last compartment is 5 μm long
+        self.assertTrue(np.all(wc[:, 1:11] == 0))
+        self.assertEqual(wc.shape[1], 15)
+
+    def test_population_matches_cells(self):
+        rng = np.random.default_rng(1)
+        r0 = rng.uniform(-200, 200, (4, 3))
+        r1 = r0 + rng.normal(size=(4, 3)) * 10
+        rN = r1 + rng.normal(size=(4, 3)) * 300
+        rD = r0 - (r1 - r0)
+        Cs = np.array([0.5, 1, 2, 4])
+        W = morphofiltdPopulation(self.re, 21, r0, r1, rN, rD, Cs, chunkSize=7)
+        self.assertEqual(W.shape, (4, len(self.re), 21))
+        for c in range(4):
+            assert_array_equal(W[c], morphofiltd(self.re, 21, r0[c], r1[c], rN[c], rD[c], Cs[c]))
+
+
+if __name__ == '__main__':
+    unittest.main()
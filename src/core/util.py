@@ -3,6 +3,10 @@
 """
 @author: Loïc Bertrand, Tony Zhou
 """
+import hashlib
+import json
+import os
+from pathlib import Path
 from typing import List
 
 import numpy as np
@@ -47,6 +51,29 @@ def upsample(arr: np.array, n: int) -> np.array:
         raise ValueError('array dimension must be 1 or 2: ' + str(n))
 
 
+def resample(arr: np.ndarray, tp: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """
+    Linearly interpolates signals sampled at ``tp`` onto the time vector
+    ``t`` (like ``np.interp``, but along the last axis of a 1-D or 2-D
+    array).
+
+    :param arr:     source signals (..., len(tp))
+    :param tp:      increasing sample times of ``arr``
+    :param t:       new sample times
+    :return:        resulting array (..., len(t))
+
+    Examples
+    --------
+    >>> resample(np.array([[0., 2.], [1., 1.]]), np.array([0, 2]), np.array([0, 1, 2]))
+    array([[0., 1., 2.],
+           [1., 1., 1.]])
+    """
+    t = np.clip(t, tp[0], tp[-1])
+    idx = np.clip(np.searchsorted(tp, t, side='right') - 1, 0, len(tp) - 2)
+    frac = (t - tp[idx]) / (tp[idx + 1] - tp[idx])
+    return arr[..., idx] * (1 - frac) + arr[..., idx + 1] * frac
+
+
 def readMatrix(file: str):
     """
     Read a space-separated file containing numbers and converts it to
@@ -142,3 +169,21 @@ def findClosestPointIndex(points: np.ndarray, target: np.ndarray) -> int:
             shortestDistIdx = index
             shortestDist = dist
     return shortestDistIdx
+
+
+def cacheDirectory(name: str) -> Path:
+    """
+    :param name:    name of the cache
+    :return:        directory of the cache, in ``$PIDR_CACHE_DIR`` (default:
+        ``~/.cache/pidr``)
+    """
+    return Path(os.environ.get('PIDR_CACHE_DIR', Path.home() / '.cache' / 'pidr')) / name
+
+
+def contentKey(**params) -> str:
+    """
+    :param params:  JSON-serializable parameters identifying a cache entry
+    :return:        content address of the entry
+    """
+    text = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()